@@ -0,0 +1,307 @@
+﻿#!/usr/bin/env python3
+"""Нагрузочный тест потокового режима с открытым циклом
+
+Запросы приходят с заданной интенсивностью (поток Пуассона или записанная трасса), не дожидаясь
+ответов на предыдущие, и все идут через один процесс и один канал stdin/stdout. Клиенты (--clients) —
+только метка запроса в записях: сумма их потоков — тот же поток Пуассона с общей интенсивностью. Для каждого запроса записывается
+ожидание в очереди и время синтеза (их измеряет сервер, параметр timing=1) и полная задержка.
+Ступени интенсивности дают кривую задержка/пропускная способность и точку насыщения.
+
+    python load_test.py --rates 0.5,1,2,4 --duration 30
+    python load_test.py --trace trace.jsonl --speeds 1,2,4 --csv requests.csv --json summary.json
+    TTS_COMMAND=dist/tts/tts python load_test.py --rates 1,2,4
+
+Трасса — JSON Lines: {"t": секунды от начала, "text": "..."} или {"t": ..., "chars": длина}.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from tts_client import AsyncTTSClient, TTSError
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Распределение длины реплик в символах: (доля, минимум, максимум) — короткие реплики,
+# обычные фразы и длинные описания
+LENGTH_DISTRIBUTION = [
+    (0.5, 10, 60),
+    (0.35, 60, 200),
+    (0.15, 200, 600),
+]
+
+WORDS = (
+    "путник золото награда деревня староста дорога мост крепость ворота ярмарка торговец "
+    "меч щит зелье задание страж король замок лес река гора ночь утро ветер огонь"
+).split()
+
+
+def sample_length(rng, lengths=None):
+    """Длина текста: из списка реальных длин (--lengths-from) или из встроенного распределения"""
+    if lengths:
+        return rng.choice(lengths)
+    pick = rng.random()
+    for share, low, high in LENGTH_DISTRIBUTION:
+        if pick < share:
+            return rng.randint(low, high)
+        pick -= share
+    return rng.randint(LENGTH_DISTRIBUTION[-1][1], LENGTH_DISTRIBUTION[-1][2])
+
+
+def make_text(rng, length, index):
+    """Уникальный текст заданной длины: номер запроса не дает серверу объединить одинаковые задачи"""
+    words = [f"Запрос {index}."]
+    size = len(words[0])
+    while size < length:
+        word = rng.choice(WORDS)
+        words.append(word)
+        size += len(word) + 1
+    return ' '.join(words).rstrip('.') + '.'
+
+
+def load_trace(path):
+    """Читает трассу: список (смещение в секундах, текст или None, длина)"""
+    trace = []
+    with open(path, encoding='utf-8') as trace_file:
+        for line in trace_file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            text = record.get('text')
+            trace.append((float(record['t']), text, len(text) if text else int(record.get('chars', 80))))
+    trace.sort(key=lambda item: item[0])
+    return trace
+
+
+def poisson_arrivals(rng, rate, duration, clients, lengths=None):
+    """Прибытия от clients клиентов, каждый — поток Пуассона с интенсивностью rate / clients
+
+    Сумма таких потоков — поток Пуассона с интенсивностью rate, так что число клиентов на нагрузку
+    не влияет: оно только помечает запросы (колонка client в --csv).
+    """
+    arrivals = []
+    for client in range(clients):
+        offset = rng.expovariate(rate / clients)
+        while offset < duration:
+            arrivals.append((offset, client, None, sample_length(rng, lengths)))
+            offset += rng.expovariate(rate / clients)
+    arrivals.sort(key=lambda item: item[0])
+    return arrivals
+
+
+def trace_arrivals(trace, speed, clients):
+    """Прибытия из трассы, ускоренной в speed раз; запросы распределяются по клиентам по кругу"""
+    return [(offset / speed, index % clients, text, length) for index, (offset, text, length) in enumerate(trace)]
+
+
+async def run_step(client, arrivals, output_dir, rng, step, request_timeout):
+    """Отправляет запросы в моменты прибытия, не дожидаясь ответов, и собирает записи о каждом"""
+    loop = asyncio.get_running_loop()
+    records = []
+
+    async def one_request(index, client_id, text):
+        record = {'step': step, 'request': index, 'client': client_id, 'chars': len(text)}
+        sent_at = loop.time()
+        try:
+            path, queue_wait, service_time = await client.synthesize_timed(
+                text, os.path.join(output_dir, f"load_{step}_{index}.wav"), timeout=request_timeout
+            )
+            record.update(status='ok', queue_wait=queue_wait, service_time=service_time)
+            os.remove(path)
+        except (TTSError, asyncio.TimeoutError, OSError) as e:
+            record.update(status='error', error=str(e) or type(e).__name__, queue_wait=None, service_time=None)
+        record['latency'] = loop.time() - sent_at
+        record['sent_at'] = sent_at - started
+        records.append(record)
+
+    started = loop.time()
+    tasks = []
+    for index, (offset, client_id, text, length) in enumerate(arrivals):
+        delay = started + offset - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        text = text or make_text(rng, length, f"{step}-{index}")
+        tasks.append(asyncio.ensure_future(one_request(index, client_id, text)))
+    sending_time = loop.time() - started
+
+    await asyncio.gather(*tasks)
+    return records, sending_time, loop.time() - started
+
+
+def summarize(records, duration, sending_time, total_time):
+    """Показатели ступени: предложенная и достигнутая интенсивность, перцентили задержек
+
+    Предложенная интенсивность — фактическое число прибытий за duration секунд; достигнутая —
+    завершенные запросы за время ступени, включая дообработку хвоста очереди.
+    """
+    total_time = max(total_time, duration)
+    ok = [record for record in records if record['status'] == 'ok']
+    latencies = np.array([record['latency'] for record in ok]) * 1000
+    waits = np.array([record['queue_wait'] for record in ok if record['queue_wait'] is not None]) * 1000
+    services = np.array([record['service_time'] for record in ok if record['service_time'] is not None]) * 1000
+
+    def percentile(values, q):
+        return round(float(np.percentile(values, q)), 1) if len(values) else None
+
+    return {
+        'offered_rate': round(len(records) / duration, 3) if duration else 0.0,
+        'requests': len(records),
+        'errors': len(records) - len(ok),
+        'throughput': round(len(ok) / total_time, 3) if total_time else 0.0,
+        'sending_time': round(sending_time, 3),
+        'drain_time': round(total_time - sending_time, 3),
+        'latency_p50_ms': percentile(latencies, 50),
+        'latency_p95_ms': percentile(latencies, 95),
+        'latency_p99_ms': percentile(latencies, 99),
+        'queue_wait_p50_ms': percentile(waits, 50),
+        'queue_wait_p95_ms': percentile(waits, 95),
+        'service_p50_ms': percentile(services, 50),
+        'service_p95_ms': percentile(services, 95),
+    }
+
+
+def is_saturated(summary, slo_ms, throughput_ratio=0.9):
+    """Насыщение: сервер не успевает за потоком запросов или p95 задержки выходит за SLO"""
+    if summary['errors']:
+        return True
+    if summary['throughput'] < summary['offered_rate'] * throughput_ratio:
+        return True
+    return summary['latency_p95_ms'] is not None and summary['latency_p95_ms'] > slo_ms
+
+
+def parse_list(value):
+    return [float(item) for item in value.split(',') if item.strip()]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Open-loop load test for main.py --stream")
+    parser.add_argument("--rates", default="0.5,1,2,4,8", help="Arrival rates to sweep, requests/sec")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds of arrivals per rate step")
+    parser.add_argument("--clients", type=int, default=10,
+                        help="Number of client labels in the records; does not change the traffic: all requests "
+                             "share one Poisson stream at the step rate and one stream process pipe")
+    parser.add_argument("--trace", help="JSON Lines trace to replay instead of Poisson arrivals")
+    parser.add_argument("--speeds", default="1", help="Trace replay speed-ups to sweep")
+    parser.add_argument("--lengths-from", help="Text file whose line lengths form the text-length distribution")
+    parser.add_argument("--slo-ms", type=float, default=5000.0, help="p95 latency limit for the saturation point")
+    parser.add_argument("--request-timeout", type=float, default=300.0, help="Per-request timeout, seconds")
+    parser.add_argument("--keep-going", action="store_true", help="Continue the sweep after saturation")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    parser.add_argument("--language", default="ru", help="Model language")
+    parser.add_argument("--server-args", default="", help="Extra arguments for the stream process")
+    parser.add_argument("--csv", help="Write per-request records to this CSV file")
+    parser.add_argument("--json", help="Write the per-step summary to this JSON file")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    lengths = None
+    if args.lengths_from:
+        with open(args.lengths_from, encoding='utf-8') as lengths_file:
+            lengths = [len(line.strip()) for line in lengths_file if line.strip()]
+    trace = load_trace(args.trace) if args.trace else None
+    steps = parse_list(args.speeds) if trace else parse_list(args.rates)
+
+    # Собранный exe можно проверить так: TTS_COMMAND=dist/tts/tts python load_test.py
+    tts_command = os.environ.get('TTS_COMMAND')
+    output_dir = tempfile.mkdtemp(prefix="tts_load_")
+
+    print("=" * 70)
+    print("=== LOAD TEST: TTS Stream Mode (open loop) ===")
+    print("=" * 70)
+    print(f"TTS command: {tts_command or 'python main.py'} {args.server_args}")
+    print(f"Arrivals: {'trace ' + args.trace if trace else 'Poisson'}, client labels: {args.clients}")
+    print(f"Steps: {', '.join(f'{step:g}' for step in steps)} {'x speed' if trace else 'req/s'}\n")
+
+    client = AsyncTTSClient(
+        language=args.language,
+        command=[tts_command] if tts_command else None,
+        extra_args=args.server_args.split(),
+        cwd=PROJECT_DIR
+    )
+    all_records = []
+    summaries = []
+    saturation = None
+    # Запуск и прогрев тоже внутри try: сервер не должен пережить тест, если они не удались
+    try:
+        await client.start()
+        # Загрузка модели не должна попасть в первую ступень
+        await client.synthesize("Прогрев.", os.path.join(output_dir, "warmup.wav"), timeout=args.request_timeout)
+
+        for step_index, step in enumerate(steps):
+            if trace:
+                arrivals = trace_arrivals(trace, step, args.clients)
+                duration = arrivals[-1][0] if arrivals else 0.0
+            else:
+                arrivals = poisson_arrivals(rng, step, args.duration, args.clients, lengths)
+                duration = args.duration
+
+            print(f"[Step {step_index + 1}] {len(arrivals)} requests in {duration:.1f}s "
+                  f"({len(arrivals) / duration if duration else 0.0:.2f} req/s) ...")
+            records, sending_time, total_time = await run_step(
+                client, arrivals, output_dir, rng, step_index + 1, args.request_timeout
+            )
+            summary = summarize(records, duration, sending_time, total_time)
+            summaries.append(summary)
+            all_records.extend(records)
+            print(f"  throughput {summary['throughput']} req/s, "
+                  f"latency p50/p95/p99 {summary['latency_p50_ms']}/{summary['latency_p95_ms']}/"
+                  f"{summary['latency_p99_ms']} ms, queue wait p95 {summary['queue_wait_p95_ms']} ms, "
+                  f"service p95 {summary['service_p95_ms']} ms, errors {summary['errors']}")
+
+            if saturation is None and is_saturated(summary, args.slo_ms):
+                saturation = summary
+                if not args.keep_going:
+                    break
+    finally:
+        await client.close()
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    print(f"\n{'=' * 70}")
+    print("=== LATENCY VS THROUGHPUT ===")
+    print("=" * 70)
+    print(f"{'offered':>10} {'achieved':>10} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'wait p95':>10} {'errors':>7}")
+    for summary in summaries:
+        print(f"{summary['offered_rate']:>10} {summary['throughput']:>10} {summary['latency_p50_ms']!s:>10} "
+              f"{summary['latency_p95_ms']!s:>10} {summary['latency_p99_ms']!s:>10} "
+              f"{summary['queue_wait_p95_ms']!s:>10} {summary['errors']:>7}")
+
+    sustainable = [summary for summary in summaries if not is_saturated(summary, args.slo_ms)]
+    print()
+    if saturation is not None:
+        print(f"Saturation point: ~{saturation['offered_rate']} req/s offered "
+              f"(achieved {saturation['throughput']} req/s, p95 {saturation['latency_p95_ms']} ms)")
+    else:
+        print("Saturation point: not reached, increase --rates")
+    if sustainable:
+        print(f"Max sustainable rate within SLO {args.slo_ms:.0f} ms: {sustainable[-1]['offered_rate']} req/s")
+
+    if args.csv:
+        fields = ['step', 'request', 'client', 'chars', 'sent_at', 'status', 'queue_wait', 'service_time',
+                  'latency', 'error']
+        with open(args.csv, 'w', newline='', encoding='utf-8') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=fields, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(all_records)
+        print(f"Per-request records: {args.csv}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as json_file:
+            json.dump({
+                'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'slo_ms': args.slo_ms,
+                'clients': args.clients,
+                'steps': summaries,
+                'saturation_rate': saturation['offered_rate'] if saturation else None,
+            }, json_file, indent=2)
+        print(f"Summary: {args.json}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
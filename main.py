@@ -4,70 +4,131 @@ import sys
 import wave
 import os
 import base64
+import itertools
 import json
+import multiprocessing
+import socket
+import struct
+import time
+import uuid
 from pathlib import Path
-from queue import Queue
-from threading import Thread
+from collections import deque, OrderedDict
+from multiprocessing import shared_memory
+from queue import PriorityQueue
+from threading import Thread, Lock, Condition, Event
+
+# Строки протокола печатаются из разных потоков и не должны перемешиваться
+_print_lock = Lock()
+
 
 def safe_print(*args, **kwargs):
     """Безопасный print для subprocess в Windows"""
-    try:
-        print(*args, **kwargs)
-    except UnicodeEncodeError:
-        # Если не получается вывести с русскими символами, выводим без них
+    with _print_lock:
         try:
-            message = ' '.join(str(arg) for arg in args)
-            safe_message = message.encode('ascii', 'replace').decode('ascii')
-            print(safe_message, **kwargs)
-        except:
-            pass  # В крайнем случае просто пропускаем вывод
+            print(*args, **kwargs)
+        except UnicodeEncodeError:
+            # Если не получается вывести с русскими символами, выводим без них
+            try:
+                message = ' '.join(str(arg) for arg in args)
+                safe_message = message.encode('ascii', 'replace').decode('ascii')
+                print(safe_message, **kwargs)
+            except:
+                pass  # В крайнем случае просто пропускаем вывод
 
 try:
-    from piper import PiperVoice
+    import numpy as np
+    import piper  # Проверяем зависимость до импорта модулей проекта
 except ImportError:
     safe_print("Error: piper-tts not installed. Install dependencies: pip install -r requirements.txt")
     sys.exit(1)
 
-
-def get_resource_path(relative_path):
-    """Получает правильный путь к ресурсам для PyInstaller"""
-    try:
-        # PyInstaller создает временную папку и сохраняет путь в _MEIPASS
-        base_path = sys._MEIPASS
-    except Exception:
-        base_path = os.path.abspath(".")
-
-    return os.path.join(base_path, relative_path)
+# Ошибки импорта модулей проекта (например, модуль не попал в сборку) не маскируем под отсутствие piper
+from tts_api import (
+    TTSEngine, PostProcessor, SentenceCache, float_to_int16, iter_sentences, parse_bool, write_wav
+)
+from tts_tune import candidate_configs, load_profile, save_profile, tune
+from tts_corpus import CorpusEntry, PhonemeCorpus, compile_corpus, config_checksum, read_catalog
 
 
 class TTSProcessor:
-    def __init__(self, models_dir="models"):
-        # Используем функцию для получения правильного пути к моделям
-        self.models_dir = Path(get_resource_path(models_dir))
+    """Консольная обертка над tts_api.TTSEngine: режимы работы, вывод сообщений и протокол stdin/stdout"""
+
+    def __init__(self, models_dir=None):
+        self.engine = TTSEngine(models_dir)
+        self.models_dir = self.engine.models_dir
         self.voice = None
         self.current_language = None
+        # Постобработка по умолчанию для всех задач (в потоковом режиме переопределяется параметрами задачи)
+        self.post_processor = PostProcessor()
+        # Необязательный кэш аудио отдельных предложений (SentenceCache)
+        self.sentence_cache = None
+        # Корпус фонем (tts_corpus.PhonemeCorpus) для синтеза записей по id без espeak
+        self.corpus = None
 
     def load_model(self, language):
         """Загружает модель для указанного языка"""
-        model_path = self.models_dir / f"{language}.onnx"
-        config_path = self.models_dir / f"{language}.onnx.json"
+        if not self.engine.is_loaded(language):
+            # Проверяем наличие файлов до сообщения о загрузке
+            self.engine.model_paths(language)
+            safe_print(f"Загружаю модель для языка: {language}")
+            self.voice = self.engine.voice(language)
+            safe_print(f"Модель {language} успешно загружена")
+        else:
+            self.voice = self.engine.voice(language)
+        self.current_language = language
 
-        if not model_path.exists():
-            raise FileNotFoundError(f"Модель {model_path} не найдена")
-        if not config_path.exists():
-            raise FileNotFoundError(f"Конфигурация {config_path} не найдена")
+    def load_corpus(self, corpus_path, language):
+        """Открывает корпус фонем и проверяет, что он собран для модели этого языка
 
-        safe_print(f"Загружаю модель для языка: {language}")
-        self.voice = PiperVoice.load(str(model_path), str(config_path))
-        self.current_language = language
-        safe_print(f"Модель {language} успешно загружена")
+        Записи, синтезируемые моделью другого языка (задания очереди с полем language),
+        дополнительно проверяет сама модель при синтезе (Voice.synthesize_ids).
+        """
+        corpus = PhonemeCorpus(corpus_path)
+        _, config_path = self.engine.model_paths(language)
+        corpus.verify(config_checksum(config_path))
+        self.corpus = corpus
+        safe_print(f"Корпус фонем: {corpus.path} (записей: {len(corpus)})")
+        return corpus
+
+    def corpus_entry(self, entry_id):
+        """id фонем записи корпуса по предложениям; ValueError, если корпуса или записи нет"""
+        if self.corpus is None:
+            raise ValueError("Корпус фонем не загружен (используйте --corpus)")
+        try:
+            return self.corpus.entry(entry_id)
+        except KeyError as e:
+            raise ValueError(e.args[0])
 
-    def text_to_speech(self, text, language, output_filename=None):
-        """Преобразует текст в речь и сохраняет в WAV файл"""
+    def synthesize_audio(self, text, language, post_processor=None, phoneme_ids=None):
+        """Синтезирует речь и возвращает массив int16 и частоту дискретизации
+
+        phoneme_ids — готовые id фонем из корпуса: текст тогда не фонемизируется.
+        """
         # Загружаем модель если нужно
         if self.current_language != language:
             self.load_model(language)
 
+        if phoneme_ids is not None:
+            return self.voice.synthesize_ids(phoneme_ids, post_processor=post_processor or self.post_processor)
+
+        result = self.voice.synthesize(
+            text, post_processor=post_processor or self.post_processor, sentence_cache=self.sentence_cache
+        )
+        if self.sentence_cache is not None:
+            hits, sentences = self.sentence_cache.last_stats()
+            safe_print(f"Кэш предложений: {hits} из {sentences}")
+        return result
+
+    def report_sentence_cache(self):
+        """Выводит итоговую долю попаданий в кэш предложений"""
+        cache = self.sentence_cache
+        if cache is not None and cache.hits + cache.misses:
+            safe_print(f"Кэш предложений всего: {cache.hits} из {cache.hits + cache.misses} "
+                       f"({cache.hit_ratio:.0%})")
+
+    def text_to_speech(self, text, language, output_filename=None, post_processor=None, phoneme_ids=None):
+        """Преобразует текст (или готовые id фонем записи корпуса) в речь и сохраняет в WAV файл"""
+
         # Генерируем имя файла если не указано
         if output_filename is None:
             output_filename = f"output_{language}.wav"
@@ -78,22 +139,56 @@ class TTSProcessor:
         safe_print(f"Язык: {language}")
         safe_print(f"Выходной файл: {output_path}")
 
-        # Синтезируем речь используя правильный API
-        audio_data = bytes()
-        for audio_chunk in self.voice.synthesize(text):
-            # Используем правильный атрибут для получения байтовых данных
-            audio_data += audio_chunk.audio_int16_bytes
+        # Синтезируем речь и применяем постобработку до записи на диск
+        audio, sample_rate = self.synthesize_audio(text, language, post_processor, phoneme_ids)
 
         # Сохраняем аудио данные в WAV файл
-        with wave.open(str(output_path), 'wb') as wav_file:
-            wav_file.setnchannels(1)  # моно
-            wav_file.setsampwidth(2)  # 16-bit
-            wav_file.setframerate(self.voice.config.sample_rate)
-            wav_file.writeframes(audio_data)
+        self.save_wav(audio, sample_rate, output_path)
 
         safe_print(f"Аудио сохранено в: {output_path.absolute()}")
         return output_path
 
+    def narrate(self, stream, language, output_filename=None, segment_duration=None, post_processor=None):
+        """Инкрементальный синтез: читает текст из потока и озвучивает его по предложениям"""
+        if self.current_language != language:
+            self.load_model(language)
+
+        post_processor = post_processor or self.post_processor
+
+        if output_filename is None:
+            output_filename = f"output_{language}.wav"
+
+        safe_print("=== TTS Инкрементальный режим запущен ===")
+        safe_print(f"Язык: {language}")
+        safe_print(f"Выходной файл: {output_filename}")
+        if segment_duration:
+            safe_print(f"Длительность сегмента: {segment_duration} сек")
+        sys.stdout.flush()
+
+        sample_rate = self.voice.sample_rate
+        writer = SegmentedWavWriter(output_filename, post_processor.output_rate(sample_rate), segment_duration)
+        # Состояние передискретизации сохраняется между предложениями, чтобы не было щелчков на стыках
+        chunk_processor = post_processor.chunk_processor(sample_rate)
+        sentences = 0
+        try:
+            for sentence in iter_sentences(stream):
+                for audio in self.voice.synthesize_iter(sentence, dtype="int16" if chunk_processor is None else "float32"):
+                    if chunk_processor is not None:
+                        audio = float_to_int16(chunk_processor(audio))
+                    finished = writer.write(audio.tobytes())
+                    for segment_path in finished:
+                        safe_print(f"SEGMENT:{segment_path.absolute()}")
+                        sys.stdout.flush()
+                sentences += 1
+        finally:
+            for segment_path in writer.close():
+                safe_print(f"SEGMENT:{segment_path.absolute()}")
+
+        safe_print(f"Озвучено предложений: {sentences}")
+        safe_print("=== TTS Инкрементальный режим завершен ===")
+        sys.stdout.flush()
+        return writer.paths
+
     def write_wav_file(self, file_handle, audio_data, sample_rate):
         """Записывает WAV файл с правильными заголовками"""
         import struct
@@ -120,135 +215,917 @@ class TTSProcessor:
 
     def save_wav(self, audio_array, sample_rate, output_path):
         """Сохраняет аудио данные в WAV файл"""
-        with wave.open(str(output_path), 'wb') as wav_file:
-            wav_file.setnchannels(1)  # моно
-            wav_file.setsampwidth(2)  # 16-бит
-            wav_file.setframerate(sample_rate)
-            wav_file.writeframes(audio_array.tobytes())
+        write_wav(output_path, audio_array, sample_rate)
 
     def list_available_models(self):
         """Показывает доступные модели в папке models"""
-        models = []
-        for file in self.models_dir.glob("*.onnx"):
-            config_file = file.with_suffix(".onnx.json")
-            if config_file.exists():
-                models.append(file.stem)
+        models = self.engine.available_languages()
 
         if models:
             safe_print("Доступные языки:")
-            for model in sorted(models):
+            for model in models:
                 safe_print(f"  - {model}")
         else:
-            safe_print("Модели не найдены в папке models/")
-            safe_print("Поместите файлы *.onnx и *.onnx.json в папку models/")
+            safe_print(f"Модели не найдены в папке {self.models_dir}")
+            safe_print("Поместите файлы *.onnx и *.onnx.json в папку models/ или укажите --models-dir")
 
         return models
 
-    def stream_mode(self, default_language="ru"):
-        """Потоковый режим: читает команды из stdin и обрабатывает их"""
+    def stream_mode(self, default_language="ru", shm_slots=0, shm_slot_size=2 * 1024 * 1024, supervisors=(),
+                    input_framing="text", prefetch_cache=32):
+        """Потоковый режим: читает команды из stdin и обрабатывает их
+
+        supervisors — рабочие процессы синтеза (SynthesisSupervisor), по рабочему потоку на каждый;
+        без них синтез идет в этом процессе в одном рабочем потоке.
+        """
         safe_print("=== TTS Потоковый режим запущен ===")
         safe_print(f"Язык: {default_language}")
-        safe_print("Формат команды: base64_текст|полный_путь_к_файлу")
-        safe_print("Или просто: base64_текст (файл будет создан в текущей директории)")
-        safe_print("Для завершения введите: exit")
-        safe_print("Ожидаю команды...\n")
-        sys.stdout.flush()
+        if len(supervisors) > 1:
+            safe_print(f"Рабочих процессов: {len(supervisors)}")
+        if input_framing == "binary":
+            safe_print(f"Формат команды: двоичный заголовок ({BINARY_FRAME_HEADER.size} байт) + текст + путь + параметры")
+        else:
+            safe_print("Формат команды: base64_текст|полный_путь_к_файлу")
+            safe_print("Или просто: base64_текст (файл будет создан в текущей директории)")
+            safe_print("Параметры задачи: base64_текст|путь|sample_rate=48000;normalize=-20;trim_silence=1")
+            if prefetch_cache:
+                safe_print("Предварительный синтез в простое: PREFETCH:base64_текст|параметры")
+            safe_print("Для завершения введите: exit")
 
-        task_queue = Queue()
+        # Кольцевой буфер в разделяемой памяти для клиентов на этом же хосте
+        audio_ring = None
+        if shm_slots:
+            audio_ring = SharedAudioRing(shm_slots, shm_slot_size)
+            safe_print(f"Разделяемая память: путь {SHM_TARGET}, освобождение слота: RELEASE:номер_слота")
+            safe_print(f"SHM:{audio_ring.name}:{shm_slots}:{shm_slot_size}")
 
-        def worker():
-            """Рабочий поток для обработки задач из очереди"""
-            while True:
-                task = task_queue.get()
-                if task is None:  # Сигнал завершения
-                    task_queue.task_done()
-                    break
+        # Машиночитаемый признак готовности для клиентов (tts_client.py)
+        safe_print("READY")
+        safe_print("Ожидаю команды...\n")
+        sys.stdout.flush()
 
-                try:
-                    base64_text, output_path = task
+        # Синтез в текущем процессе или в перезапускаемых рабочих процессах
+        synthesizers = [supervisor.synthesize_audio for supervisor in supervisors] or [self.synthesize_audio]
 
-                    # Декодируем base64
-                    text = decode_base64_text(base64_text)
+        def reply(status, request_id, message):
+            """Печатает ответ планировщика (ERROR, TIMING) клиенту"""
+            safe_print(format_reply(status, request_id, message))
+            sys.stdout.flush()
 
-                    # Создаем директорию если её нет
-                    output_dir = os.path.dirname(output_path)
-                    if output_dir and not os.path.exists(output_dir):
-                        os.makedirs(output_dir, exist_ok=True)
+        def deliver(output_path, request_id, audio, sample_rate):
+            """Отдает готовое аудио одному запросившему: в файл или в слот разделяемой памяти"""
+            try:
+                if output_path == SHM_TARGET:
+                    # PCM кладем в свободный слот, клиент читает его без файловой системы
+                    if audio_ring is None:
+                        raise ValueError("Разделяемая память не включена (используйте --shm-slots)")
+                    slot, offset, length = audio_ring.put(audio)
+                    safe_print(format_reply(
+                        "SUCCESS", request_id,
+                        f"{SHM_TARGET}{audio_ring.name}:{slot}:{offset}:{length}:{sample_rate}"
+                    ))
+                    sys.stdout.flush()
+                    return
 
-                    # Генерируем речь с языком из аргументов запуска
-                    result = self.text_to_speech(text, default_language, output_path)
+                # Создаем директорию если её нет
+                output_dir = os.path.dirname(output_path)
+                if output_dir and not os.path.exists(output_dir):
+                    os.makedirs(output_dir, exist_ok=True)
 
-                    # Выводим результат
-                    safe_print(f"SUCCESS:{result}")
-                    sys.stdout.flush()
+                self.save_wav(audio, sample_rate, output_path)
 
-                except Exception as e:
-                    safe_print(f"ERROR:{str(e)}")
-                    sys.stdout.flush()
+                # Выводим результат
+                safe_print(format_reply("SUCCESS", request_id, output_path))
+                sys.stdout.flush()
 
-                task_queue.task_done()
+            except Exception as e:
+                safe_print(format_reply("ERROR", request_id, str(e)))
+                sys.stdout.flush()
 
-        # Запускаем рабочий поток
-        worker_thread = Thread(target=worker, daemon=True)
-        worker_thread.start()
+        scheduler = StreamScheduler(synthesizers, default_language, deliver, reply, prefetch_cache)
+        scheduler.start()
 
         # Читаем команды из stdin
-        try:
-            for line in sys.stdin:
-                line = line.strip()
-
-                if not line:
-                    continue
+        if input_framing == "binary":
+            commands = iter_binary_commands(sys.stdin.buffer)
+        else:
+            commands = iter_text_commands(sys.stdin)
 
+        try:
+            for command, request_id, payload in commands:
                 # Команда завершения
-                if line.lower() == "exit":
+                if command == "exit":
                     safe_print("Получена команда завершения. Завершаю работу...")
                     sys.stdout.flush()
                     break
 
-                # Парсим команду: base64_текст|путь или просто base64_текст
-                parts = line.split('|')
+                if command == "error":
+                    safe_print(format_reply("ERROR", request_id, payload))
+                    sys.stdout.flush()
+                    continue
+
+                # Клиент закончил читать аудио из слота разделяемой памяти
+                if command == "release":
+                    try:
+                        if audio_ring is None:
+                            raise ValueError("Разделяемая память не включена (используйте --shm-slots)")
+                        audio_ring.release(payload)
+                    except ValueError as e:
+                        safe_print(format_reply("ERROR", request_id, e))
+                        sys.stdout.flush()
+                    continue
+
+                if command == "prefetch" and scheduler.prefetch_store is None:
+                    safe_print(format_reply("ERROR", request_id, "Предварительный синтез отключен (--prefetch-cache 0)"))
+                    sys.stdout.flush()
+                    continue
+
+                text, output_path, params = payload
+                try:
+                    # timing=1: перед ответом сообщить время ожидания в очереди и время синтеза
+                    queued_at = time.perf_counter() if parse_bool(params.pop('timing', '0')) else None
+                    # entry=ID: синтез записи корпуса фонем (--corpus) вместо текста
+                    entry = params.pop('entry', None)
+                    phoneme_ids = self.corpus_entry(entry) if entry is not None else None
+                    if entry is not None and not text:
+                        text = f"[{entry}]"
+                    # Параметры задачи дополняют параметры запуска
+                    post_processor = self.post_processor
+                    if params:
+                        post_processor = PostProcessor.from_params(params, self.post_processor)
+                except ValueError as e:
+                    safe_print(format_reply("ERROR", request_id, e))
+                    sys.stdout.flush()
+                    continue
+
+                key = (text, default_language, post_processor.key, entry)
+                if command == "prefetch":
+                    scheduler.prefetch(key, text, post_processor, phoneme_ids)
+                    continue
 
-                if len(parts) == 1:
-                    # Только base64 текст, генерируем имя автоматически
-                    base64_text = parts[0]
+                if not output_path:
                     # Генерируем уникальное имя файла в текущей директории
-                    import time
                     timestamp = int(time.time() * 1000)
                     output_path = f"output_{timestamp}.wav"
-                elif len(parts) == 2:
-                    # base64 текст и путь к файлу (может быть полным путем)
-                    base64_text, output_path = parts
-                else:
-                    safe_print(f"ERROR:Неверный формат команды. Ожидается: base64_текст|путь или base64_текст")
-                    sys.stdout.flush()
-                    continue
 
-                # Добавляем задачу в очередь
-                task_queue.put((base64_text, output_path))
-                safe_print(f"QUEUED:{output_path}")
+                # QUEUED раньше постановки в очередь, чтобы ответ о результате не мог его опередить
+                safe_print(format_reply("QUEUED", request_id, output_path))
                 sys.stdout.flush()
+                scheduler.submit(key, text, post_processor, phoneme_ids, output_path, request_id, queued_at)
 
         except KeyboardInterrupt:
             safe_print("\nПолучен сигнал прерывания. Завершаю работу...")
             sys.stdout.flush()
 
         # Ждем завершения всех задач
-        task_queue.put(None)  # Сигнал завершения для worker
-        task_queue.join()
-        worker_thread.join(timeout=5)
+        scheduler.shutdown()
+
+        for supervisor in supervisors:
+            supervisor.stop()
+
+        if audio_ring is not None:
+            audio_ring.close()
 
+        if scheduler.coalesced:
+            safe_print(f"Объединено одинаковых задач: {scheduler.coalesced}")
+        self.report_sentence_cache()
+        if scheduler.prefetched or scheduler.prefetch_hits:
+            safe_print(f"Предварительный синтез: выполнено {scheduler.prefetched}, "
+                       f"использовано {scheduler.prefetch_hits}, отменено {scheduler.prefetch_cancelled}, "
+                       f"вытеснено без использования {scheduler.prefetch_store.evicted_unused}")
         safe_print("=== TTS Потоковый режим завершен ===")
         sys.stdout.flush()
 
+    def spool_mode(self, spool_dir, default_language="ru", lease_timeout=300.0, poll_interval=1.0,
+                   max_attempts=3, once=False, supervisor=None):
+        """Режим очереди в общей папке: задания-файлы JSON разбирают процессы на любых хостах"""
+        spool = SpoolDirectory(spool_dir, lease_timeout, max_attempts)
+        synthesize_audio = supervisor.synthesize_audio if supervisor is not None else self.synthesize_audio
+
+        safe_print("=== TTS Режим очереди в папке запущен ===")
+        safe_print(f"Папка очереди: {spool.root}")
+        safe_print(f"Обработчик: {spool.worker_id}")
+        safe_print(f"Аренда задания: {lease_timeout} сек")
+        sys.stdout.flush()
+
+        processed = 0
+        try:
+            while True:
+                for job_name in spool.reclaim_stale():
+                    safe_print(f"Задание {job_name} возвращено в очередь (аренда истекла)")
+                    sys.stdout.flush()
+
+                claimed = spool.claim_next()
+                if claimed is None:
+                    if once:
+                        break
+                    time.sleep(poll_interval)
+                    continue
+
+                job_path, job = claimed
+                # Пока идет синтез, продлеваем аренду, чтобы задание не забрали другие обработчики
+                with spool.lease(job_path):
+                    started = time.time()
+                    try:
+                        # Задание с полем entry синтезирует запись корпуса фонем (--corpus)
+                        entry = job.get('entry')
+                        phoneme_ids = self.corpus_entry(str(entry)) if entry is not None else None
+                        text = job.get('text') or f"[{entry}]"
+                        language = job.get('language', default_language)
+                        post_processor = PostProcessor.from_params(job.get('params') or {}, self.post_processor)
+                        output_path = spool.output_path(job_path, job.get('output'))
+
+                        safe_print(f"Синтезирую речь: '{text}'")
+                        audio, sample_rate = synthesize_audio(text, language, post_processor, phoneme_ids)
+                        output_path.parent.mkdir(parents=True, exist_ok=True)
+                        self.save_wav(audio, sample_rate, output_path)
+                        result = {'status': 'done', 'output': str(output_path)}
+                    except Exception as e:
+                        result = {'status': 'failed', 'error': str(e) or type(e).__name__}
+
+                result.update({
+                    'worker': spool.worker_id,
+                    'started_at': started,
+                    'duration': round(time.time() - started, 3),
+                })
+                if spool.complete(job_path, job, result):
+                    processed += 1
+                    if result['status'] == 'done':
+                        safe_print(f"SUCCESS:{result['output']}")
+                    else:
+                        safe_print(f"ERROR:{spool.job_name(job_path)}: {result['error']}")
+                else:
+                    safe_print(f"Задание {spool.job_name(job_path)} уже забрал другой обработчик (аренда истекла)")
+                sys.stdout.flush()
+
+        except KeyboardInterrupt:
+            safe_print("\nПолучен сигнал прерывания. Завершаю работу...")
+
+        if supervisor is not None:
+            supervisor.stop()
+
+        self.report_sentence_cache()
+        safe_print(f"Обработано заданий: {processed}")
+        safe_print("=== TTS Режим очереди в папке завершен ===")
+        sys.stdout.flush()
+
+
+class SpoolDirectory:
+    """Общая папка заданий: incoming/ -> processing/ -> done/ или failed/
+
+    Задание захватывается атомарным переименованием в processing/ под именем, уникальным для
+    захвата (<имя>.<метка>.claim), поэтому одно задание получает ровно один обработчик даже при
+    нескольких процессах на разных хостах (NFS). Обработчик продлевает аренду, обновляя mtime файла;
+    задания с истекшей арендой (обработчик умер) возвращаются в incoming/. Время аренды сравнивается
+    со временем файловой системы, а не с часами хоста, поэтому расхождение часов хостов ей не мешает.
+    Обработчик, у которого задание уже забрали, не может его завершить: файла с его меткой больше нет.
+    """
+
+    CLAIM_SUFFIX = ".claim"
+
+    def __init__(self, root, lease_timeout=300.0, max_attempts=3):
+        self.root = Path(root).absolute()
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.incoming = self.root / "incoming"
+        self.processing = self.root / "processing"
+        self.done = self.root / "done"
+        self.failed = self.root / "failed"
+        for directory in (self.incoming, self.processing, self.done, self.failed):
+            directory.mkdir(parents=True, exist_ok=True)
+        # Общий файл, по mtime которого узнаем текущее время файловой системы
+        self._clock_path = self.root / ".clock"
+
+    @classmethod
+    def job_name(cls, job_path):
+        """Исходное имя задания по имени захваченного файла"""
+        name = job_path.name
+        if name.endswith(cls.CLAIM_SUFFIX):
+            name = name[:-len(cls.CLAIM_SUFFIX)].rpartition('.')[0]
+        return name
+
+    def filesystem_time(self):
+        """Текущее время по часам файловой системы (сервера NFS), а не этого хоста"""
+        with open(self._clock_path, 'a'):
+            pass
+        os.utime(self._clock_path)
+        return self._clock_path.stat().st_mtime
+
+    def claim_next(self):
+        """Захватывает следующее задание; возвращает (путь в processing/, задание) или None"""
+        for job_file in sorted(self.incoming.glob("*.json")):
+            claimed_path = self.processing / f"{job_file.name}.{uuid.uuid4().hex}{self.CLAIM_SUFFIX}"
+            try:
+                # Свежий mtime — начало аренды (rename его не меняет); ставим до переноса,
+                # чтобы другой обработчик не успел счесть задание просроченным
+                os.utime(job_file)
+                os.rename(job_file, claimed_path)
+            except FileNotFoundError:
+                continue  # Задание уже забрал другой обработчик
+
+            try:
+                with open(claimed_path, encoding='utf-8') as job_file_handle:
+                    job = json.load(job_file_handle)
+                if not isinstance(job, dict) or ('text' not in job and 'entry' not in job):
+                    raise ValueError("Задание должно быть JSON объектом с полем text или entry")
+            except (OSError, ValueError) as e:
+                # Исходный файл не переписываем: переносим как есть, чтобы его можно было исправить
+                safe_print(f"ERROR:{job_file.name}: Неверное задание: {e}")
+                try:
+                    os.replace(claimed_path, self.failed / job_file.name)
+                except FileNotFoundError:
+                    pass
+                continue
+
+            job['attempts'] = job.get('attempts', 0) + 1
+            job['claimed_by'] = self.worker_id
+            if job['attempts'] > self.max_attempts:
+                safe_print(f"ERROR:{job_file.name}: Превышено число попыток ({self.max_attempts})")
+                self._finish(claimed_path, job, self.failed, {
+                    'status': 'failed',
+                    'error': f"Превышено число попыток ({self.max_attempts})",
+                    'worker': self.worker_id
+                })
+                continue
+
+            try:
+                self._write_json(claimed_path, job)
+            except FileNotFoundError:
+                continue
+            return claimed_path, job
+        return None
+
+    def reclaim_stale(self):
+        """Возвращает в очередь задания, аренда которых истекла; возвращает их имена"""
+        reclaimed = []
+        now = self.filesystem_time()
+        for job_path in self.processing.glob(f"*{self.CLAIM_SUFFIX}"):
+            try:
+                if now - job_path.stat().st_mtime < self.lease_timeout:
+                    continue
+                os.replace(job_path, self.incoming / self.job_name(job_path))
+                reclaimed.append(self.job_name(job_path))
+            except FileNotFoundError:
+                continue  # Задание завершено или уже возвращено другим обработчиком
+        return reclaimed
+
+    def lease(self, job_path):
+        """Контекстный менеджер, продлевающий аренду задания в фоновом потоке"""
+        return _LeaseKeeper(job_path, max(self.lease_timeout / 3, 0.1))
+
+    def output_path(self, job_path, output):
+        """Путь результата: относительные пути считаются от папки очереди"""
+        if not output:
+            return self.root / "output" / f"{Path(self.job_name(job_path)).stem}.wav"
+        output_path = Path(output)
+        return output_path if output_path.is_absolute() else self.root / output_path
+
+    def complete(self, job_path, job, result):
+        """Переносит задание с результатом в done/ или failed/; False, если задание уже не наше"""
+        target_dir = self.done if result['status'] == 'done' else self.failed
+        return self._finish(job_path, job, target_dir, result)
+
+    def _finish(self, job_path, job, target_dir, result):
+        # Сначала забираем свой захват атомарным переименованием: если аренда истекла и задание
+        # вернули в очередь, файла с нашей меткой уже нет и результат не записывается
+        finishing_path = target_dir / f".{job_path.name}.part"
+        try:
+            os.rename(job_path, finishing_path)
+        except FileNotFoundError:
+            return False
+        job = dict(job, result=dict(result, finished_at=time.time()))
+        self._write_json(finishing_path, job)
+        os.replace(finishing_path, target_dir / self.job_name(job_path))
+        return True
+
+    def _write_json(self, path, data):
+        # Пишем во временный файл рядом и атомарно заменяем
+        temp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        with open(temp_path, 'w', encoding='utf-8') as temp_file:
+            json.dump(data, temp_file, ensure_ascii=False, indent=2)
+        if not path.exists():
+            os.remove(temp_path)
+            raise FileNotFoundError(path)
+        os.replace(temp_path, path)
+
+
+class _LeaseKeeper:
+    """Обновляет mtime захваченного задания, пока идет его обработка"""
+
+    def __init__(self, job_path, interval):
+        self.job_path = job_path
+        self.interval = interval
+        self._stop = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                os.utime(self.job_path)
+            except FileNotFoundError:
+                break
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def current_rss_mb():
+    """Текущий объем резидентной памяти процесса в МБ (None, если определить не удалось)"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / (1024 * 1024)
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as statm:
+            resident_pages = int(statm.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _synthesis_worker_main(conn, models_dir, language, sentence_cache_options=None, threads=None):
+    """Точка входа рабочего процесса синтеза"""
+    # stdout родителя занят протоколом, диагностику рабочего процесса пишем в stderr
+    sys.stdout = sys.stderr
+    try:
+        voice = TTSEngine(models_dir, threads=threads).voice(language)
+        # Кэш в памяти живет до перезапуска процесса, файловый кэш (cache_dir) переживает его
+        sentence_cache = SentenceCache(**sentence_cache_options) if sentence_cache_options else None
+        conn.send(('ready', current_rss_mb()))
+
+        while True:
+            task = conn.recv()
+            if task is None:
+                break
+            text, post_processor, phoneme_ids = task
+            try:
+                if phoneme_ids is not None:
+                    audio, sample_rate = voice.synthesize_ids(phoneme_ids, post_processor=post_processor)
+                else:
+                    audio, sample_rate = voice.synthesize(text, post_processor=post_processor,
+                                                          sentence_cache=sentence_cache)
+                conn.send(('ok', (audio, sample_rate), current_rss_mb()))
+            except Exception as e:
+                conn.send(('error', str(e), current_rss_mb()))
+    except (EOFError, KeyboardInterrupt):
+        pass
+
+
+class WorkerCrashed(RuntimeError):
+    """Рабочий процесс синтеза неожиданно завершился"""
+
+
+class SynthesisSupervisor:
+    """Выполняет синтез в рабочем процессе: таймаут задачи, перезапуск после падения и рециклинг"""
+
+    def __init__(self, models_dir, language, task_timeout=None, recycle_after=None, max_rss_mb=None,
+                 task_retries=1, sentence_cache_options=None, threads=None):
+        self.models_dir = str(models_dir)
+        self.language = language
+        self.task_timeout = task_timeout
+        self.recycle_after = recycle_after
+        self.max_rss_mb = max_rss_mb
+        self.task_retries = task_retries
+        # Параметры SentenceCache и число потоков onnxruntime рабочего процесса
+        self.sentence_cache_options = sentence_cache_options
+        self.threads = threads
+        # spawn: безопасно при работающих потоках и одинаково ведет себя на всех ОС
+        self._context = multiprocessing.get_context('spawn')
+        self._process = None
+        self._conn = None
+        self._tasks_done = 0
+        self._ready = False
+        # Фоновая замена процесса при рециклинге (завершение старого и запуск нового)
+        self._recycler = None
+
+    def start(self):
+        self._spawn()
+        return self._wait_ready()
+
+    def _spawn(self):
+        """Запускает рабочий процесс, не дожидаясь загрузки модели"""
+        parent_conn, child_conn = self._context.Pipe()
+        self._process = self._context.Process(
+            target=_synthesis_worker_main,
+            args=(child_conn, self.models_dir, self.language, self.sentence_cache_options, self.threads),
+            daemon=True
+        )
+        self._process.start()
+        child_conn.close()
+        self._conn = parent_conn
+        self._tasks_done = 0
+        self._ready = False
+
+    def _wait_ready(self):
+        # Ждем загрузки модели (без таймаута задачи: загрузка может быть долгой)
+        try:
+            message = self._conn.recv()
+        except EOFError:
+            exitcode = self._kill_process()
+            raise WorkerCrashed(f"Рабочий процесс не запустился (код {exitcode})")
+        self._ready = True
+        safe_print(f"Рабочий процесс запущен (PID {self._process.pid})")
+        sys.stdout.flush()
+        return message
+
+    def _wait_recycled(self):
+        if self._recycler is not None:
+            self._recycler.join()
+            self._recycler = None
+
+    def stop(self):
+        """Штатно завершает рабочий процесс"""
+        self._wait_recycled()
+        self._stop_process()
+
+    def _stop_process(self):
+        if self._process is None:
+            return
+        if not self._ready:
+            # Модель еще загружается: ждать ее ради завершения незачем
+            self._kill_process()
+            return
+        try:
+            self._conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self._process.join(timeout=5)
+        if self._process.is_alive():
+            self._process.kill()
+            self._process.join()
+        self._conn.close()
+        self._process = None
+
+    def kill(self):
+        """Принудительно завершает зависший или упавший рабочий процесс и возвращает его код"""
+        self._wait_recycled()
+        return self._kill_process()
+
+    def _kill_process(self):
+        if self._process is None:
+            return None
+        self._process.kill()
+        self._process.join()
+        exitcode = self._process.exitcode
+        self._conn.close()
+        self._process = None
+        return exitcode
+
+    def recycle(self, reason):
+        """Заменяет рабочий процесс новым в фоновом потоке: ответ на текущую задачу не ждет ни
+        завершения старого процесса, ни загрузки модели нового; следующая задача дождется готовности"""
+        safe_print(f"Перезапуск рабочего процесса: {reason}")
+        sys.stdout.flush()
+        self._wait_recycled()
+        self._recycler = Thread(target=self._replace_process, daemon=True)
+        self._recycler.start()
+
+    def _replace_process(self):
+        self._stop_process()
+        self._spawn()
+
+    def synthesize_audio(self, text, language, post_processor=None, phoneme_ids=None):
+        """Синтезирует речь в рабочем процессе, возвращает массив int16 и частоту дискретизации"""
+        if language != self.language:
+            raise ValueError(f"Рабочий процесс загружен для языка {self.language}")
+        if phoneme_ids is not None:
+            # Срезы отображенного в память корпуса передаем обычными массивами; рабочий процесс
+            # сверяет контрольную сумму корпуса со своей моделью
+            phoneme_ids = CorpusEntry((np.array(ids) for ids in phoneme_ids), getattr(phoneme_ids, 'checksum', None))
+
+        attempts = 0
+        while True:
+            self._wait_recycled()
+            if self._process is None:
+                self.start()
+            elif not self._ready:
+                self._wait_ready()
+            try:
+                self._conn.send((text, post_processor, phoneme_ids))
+                finished = self._conn.poll(self.task_timeout)
+                if finished:
+                    status, payload, rss_mb = self._conn.recv()
+            except (EOFError, OSError) as e:
+                exitcode = self.kill()
+                attempts += 1
+                if attempts > self.task_retries:
+                    raise WorkerCrashed(f"Рабочий процесс завершился аварийно (код {exitcode})") from e
+                safe_print(f"Рабочий процесс завершился аварийно (код {exitcode}), повторяю задачу...")
+                sys.stdout.flush()
+                continue
+
+            if not finished:
+                # Зависший синтез не повторяем: скорее всего он зависнет снова
+                self.kill()
+                raise TimeoutError(f"Превышено время синтеза ({self.task_timeout} сек)")
+
+            # Замена процесса идет в фоне: ответ на эту задачу ее не ждет
+            self._recycle_if_needed(rss_mb)
+            if status == 'error':
+                raise RuntimeError(payload)
+            return payload
+
+    def _recycle_if_needed(self, rss_mb):
+        self._tasks_done += 1
+        if self.recycle_after and self._tasks_done >= self.recycle_after:
+            self.recycle(f"выполнено задач: {self._tasks_done}")
+        elif self.max_rss_mb and rss_mb is not None and rss_mb > self.max_rss_mb:
+            self.recycle(f"память {rss_mb:.0f} МБ > {self.max_rss_mb} МБ")
+
+
+# Путь задачи, означающий выдачу аудио через разделяемую память вместо файла
+SHM_TARGET = "shm:"
+
+
+class SharedAudioRing:
+    """Кольцо слотов фиксированного размера в multiprocessing.shared_memory для передачи PCM"""
+
+    def __init__(self, slots, slot_size, wait_timeout=5.0):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.wait_timeout = wait_timeout
+        self.shm = shared_memory.SharedMemory(create=True, size=slots * slot_size)
+        self._free = deque(range(slots))
+        self._busy = set()
+        self._condition = Condition()
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def put(self, audio):
+        """Копирует int16 аудио в свободный слот и возвращает (слот, смещение, длина в байтах)"""
+        length = audio.nbytes
+        if length > self.slot_size:
+            raise ValueError(f"Аудио ({length} байт) не помещается в слот ({self.slot_size} байт)")
+
+        with self._condition:
+            # Если все слоты заняты, ждем пока клиент освободит какой-нибудь
+            if not self._condition.wait_for(lambda: self._free, timeout=self.wait_timeout):
+                raise TimeoutError("Нет свободных слотов разделяемой памяти (клиент не вызывает RELEASE)")
+            slot = self._free.popleft()
+            self._busy.add(slot)
+
+        offset = slot * self.slot_size
+        target = np.ndarray(audio.shape, dtype=np.int16, buffer=self.shm.buf, offset=offset)
+        target[:] = audio
+        del target  # Иначе shared memory нельзя будет закрыть
+        return slot, offset, length
+
+    def release(self, slot):
+        """Возвращает слот в кольцо после того, как клиент прочитал аудио"""
+        with self._condition:
+            if slot not in self._busy:
+                raise ValueError(f"Слот {slot} не занят")
+            self._busy.remove(slot)
+            self._free.append(slot)
+            self._condition.notify()
+
+    def close(self):
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            # Сегмент уже удалил resource_tracker клиента (Python < 3.13)
+            pass
+
+
+class PrefetchStore:
+    """Ограниченное LRU хранилище результатов предварительного синтеза"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.evicted_unused = 0
+        # ключ задачи -> [аудио, частота дискретизации, был ли использован]
+        self._entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """Возвращает (аудио, частота) или None; использованный результат остается в хранилище"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        entry[2] = True
+        return entry[0], entry[1]
+
+    def put(self, key, audio, sample_rate, used=False):
+        """used — результат уже выдан запросу, присоединившемуся к предсинтезу"""
+        self._entries[key] = [audio, sample_rate, used]
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            _, (_, _, used) = self._entries.popitem(last=False)
+            if not used:
+                self.evicted_unused += 1
+
+
+class StreamScheduler:
+    """Очередь задач потокового режима и рабочие потоки синтеза
+
+    Одинаковые задачи (ключ: текст, язык, параметры) в очереди или в работе синтезируются один раз,
+    результат получают все запросившие. Реальные задачи идут раньше предварительных (PREFETCH),
+    поэтому предсинтез занимает только простой; еще не начатые предсинтезы отменяются реальным
+    запросом. Выдача готового результата предсинтеза идет раньше всего и тоже выполняется рабочим
+    потоком: запись в слот разделяемой памяти может ждать RELEASE, который читает поток команд.
+
+    synthesizers — функции synthesize_audio(текст, язык, постпроцессор, id фонем), по рабочему потоку
+    на каждую; deliver(путь, id запроса, аудио, частота) выдает результат и отвечает SUCCESS/ERROR;
+    reply(статус, id запроса, сообщение) печатает остальные ответы (ERROR, TIMING).
+    """
+
+    DELIVER, TASK, PREFETCH, SHUTDOWN = 0, 1, 2, 3
+
+    def __init__(self, synthesizers, language, deliver, reply, prefetch_cache=32):
+        self.synthesizers = list(synthesizers)
+        self.language = language
+        self.deliver = deliver
+        self.reply = reply
+        # Результаты предсинтеза ждут реального запроса
+        self.prefetch_store = PrefetchStore(prefetch_cache) if prefetch_cache else None
+        self.coalesced = 0
+        self.prefetched = 0
+        self.prefetch_hits = 0
+        self.prefetch_cancelled = 0
+
+        self._queue = PriorityQueue()
+        self._order = itertools.count()
+        # ключ задачи -> список (путь, id запроса, время постановки в очередь для timing=1) всех запросивших
+        self._inflight = {}
+        self._prefetch_pending = set()
+        self._lock = Lock()
+        # Что сейчас делает каждый рабочий поток: (ключ, еще не получившие ответ) или None.
+        # Пока идет синтез, ожидающие лежат в _inflight и вместо списка стоит None
+        self._current = [None] * len(self.synthesizers)
+        # Признак штатного завершения потока по сигналу SHUTDOWN
+        self._stopped = [False] * len(self.synthesizers)
+        self._threads = [None] * len(self.synthesizers)
+
+    def start(self):
+        for index in range(len(self.synthesizers)):
+            self._start_thread(index)
+
+    def _start_thread(self, index):
+        self._threads[index] = Thread(target=self._worker, args=(index,), daemon=True)
+        self._threads[index].start()
+
+    def _put(self, priority, task):
+        self._queue.put((priority, next(self._order), task))
+
+    def submit(self, key, text, post_processor, phoneme_ids, output_path, request_id=None, queued_at=None):
+        """Ставит реальную задачу: берет готовый результат предсинтеза, присоединяет к идентичной
+        задаче или добавляет новую"""
+        requester = (output_path, request_id, queued_at)
+        with self._lock:
+            self._cancel_prefetches()
+            self._ensure_workers()
+            cached = self.prefetch_store.get(key) if self.prefetch_store is not None else None
+            if cached is not None:
+                self.prefetch_hits += 1
+                self._put(self.DELIVER, (requester, *cached))
+            elif key in self._inflight:
+                self._inflight[key].append(requester)
+                self.coalesced += 1
+            else:
+                self._inflight[key] = [requester]
+                self._put(self.TASK, (text, post_processor, key, False, phoneme_ids))
+
+    def prefetch(self, key, text, post_processor, phoneme_ids):
+        """Подсказка клиента: синтезировать, когда не будет реальной работы; False, если не нужна"""
+        with self._lock:
+            if (self.prefetch_store is None or not text.strip() or key in self._inflight
+                    or key in self.prefetch_store):
+                return False
+            self._inflight[key] = []
+            self._prefetch_pending.add(key)
+            self._ensure_workers()
+            self._put(self.PREFETCH, (text, post_processor, key, True, phoneme_ids))
+            return True
+
+    def shutdown(self):
+        """Дожидается всех реальных задач (предсинтез больше никому не нужен) и завершает потоки"""
+        with self._lock:
+            self._cancel_prefetches()
+            self._ensure_workers()
+        for _ in self._threads:
+            self._put(self.SHUTDOWN, None)  # Сигнал завершения для каждого потока
+        # Как join() очереди, но поток, завершившийся на оставшейся задаче, тоже перезапускается
+        while True:
+            with self._queue.all_tasks_done:
+                if not self._queue.unfinished_tasks:
+                    break
+                self._queue.all_tasks_done.wait(0.5)
+            with self._lock:
+                self._ensure_workers()
+        for thread in self._threads:
+            thread.join(timeout=5)
+
+    def _cancel_prefetches(self):
+        """Отменяет предсинтезы, которые еще не начались (вызывается под _lock)"""
+        for key in self._prefetch_pending:
+            del self._inflight[key]
+        self.prefetch_cancelled += len(self._prefetch_pending)
+        self._prefetch_pending.clear()
+
+    def _ensure_workers(self):
+        """Перезапускает рабочие потоки, если какой-то неожиданно завершился (вызывается под _lock)
+
+        Задача, на которой поток завершился, считается выполненной с ошибкой: ожидающие ее получают
+        ERROR, иначе присоединенные к ней запросы и завершение работы ждали бы ее вечно.
+        """
+        for index, thread in enumerate(self._threads):
+            if thread.is_alive() or self._stopped[index]:
+                continue
+            safe_print("Рабочий поток завершился, перезапускаю...")
+            current = self._current[index]
+            if current is not None:
+                key, waiting = current
+                if waiting is None:
+                    waiting = self._inflight.pop(key, [])
+                self._current[index] = None
+                for _, request_id, _ in waiting:
+                    self.reply("ERROR", request_id, "Рабочий поток завершился во время синтеза")
+                self._queue.task_done()
+            self._start_thread(index)
+
+    def _worker(self, index):
+        """Рабочий поток для обработки задач из очереди"""
+        synthesize_audio = self.synthesizers[index]
+        while True:
+            priority, _, task = self._queue.get()
+            if task is None:  # Сигнал завершения
+                self._stopped[index] = True
+                self._queue.task_done()
+                break
+
+            if priority == self.DELIVER:
+                # Результат предсинтеза: запрос ждал в очереди только выдачи
+                requester, audio, sample_rate = task
+                self._current[index] = (None, [requester])
+                now = time.perf_counter()
+                self._respond(index, now, now, audio, sample_rate, None)
+                continue
+
+            text, post_processor, key, speculative, phoneme_ids = task
+            with self._lock:
+                if speculative:
+                    if key not in self._prefetch_pending:
+                        # Отменен реальным запросом, пока ждал в очереди
+                        self._queue.task_done()
+                        continue
+                    self._prefetch_pending.remove(key)
+                self._current[index] = (key, None)
+
+            started = time.perf_counter()
+            audio = sample_rate = None
+            try:
+                safe_print(f"{'Предварительно синтезирую' if speculative else 'Синтезирую'} речь: '{text}'")
+                audio, sample_rate = synthesize_audio(text, self.language, post_processor, phoneme_ids)
+                error = None
+            except Exception as e:
+                error = e
+            finished = time.perf_counter()
+
+            # Забираем всех ожидающих; новые дубликаты после этого встанут в очередь заново
+            with self._lock:
+                requesters = self._inflight.pop(key)
+                self._current[index] = (key, list(requesters))
+                if speculative and error is None:
+                    self.prefetch_store.put(key, audio, sample_rate, used=bool(requesters))
+                    self.prefetched += 1
+            self._respond(index, started, finished, audio, sample_rate, error)
+
+    def _respond(self, index, started, finished, audio, sample_rate, error):
+        """Отвечает всем ожидающим текущей задачи потока и отмечает задачу выполненной"""
+        waiting = self._current[index][1]
+        while waiting:
+            output_path, request_id, queued_at = waiting[0]
+            if queued_at is not None:
+                # Присоединившийся во время синтеза запрос не ждал в очереди
+                begin = max(started, queued_at)
+                self.reply("TIMING", request_id, f"{(begin - queued_at) * 1000:.1f}:{(finished - begin) * 1000:.1f}")
+            if error is not None:
+                self.reply("ERROR", request_id, str(error))
+            else:
+                self.deliver(output_path, request_id, audio, sample_rate)
+            waiting.pop(0)
+        self._current[index] = None
+        self._queue.task_done()
+
 
 def decode_base64_text(base64_text):
     """Декодирует текст из base64 формата"""
     try:
-        # Удаляем возможные пробелы и переносы строк
-        cleaned_base64 = base64_text.replace(' ', '').replace('\n', '').replace('\r', '')
-        # Декодируем из base64
-        decoded_bytes = base64.b64decode(cleaned_base64)
+        # Декодируем из base64 (пробелы и переносы строк b64decode отбрасывает сам)
+        decoded_bytes = base64.b64decode(base64_text)
         # Преобразуем в строку с UTF-8 кодировкой
         decoded_text = decoded_bytes.decode('utf-8')
         return decoded_text
@@ -256,32 +1133,504 @@ def decode_base64_text(base64_text):
         raise ValueError(f"Ошибка декодирования base64: {e}")
 
 
+def format_reply(status, request_id, message):
+    """Формирует строку ответа; если клиент передал id запроса, он добавляется после статуса"""
+    if request_id:
+        return f"{status}#{request_id}:{message}"
+    return f"{status}:{message}"
+
+
+def iter_text_commands(stream):
+    """Разбирает текстовый протокол: base64_текст|путь|параметры по одной команде в строке
+
+    Выдает кортежи (команда, id запроса, данные).
+    """
+    for line in stream:
+        line = line.strip()
+
+        if not line:
+            continue
+
+        if line.lower() == "exit":
+            yield "exit", None, None
+            return
+
+        # Подсказка предварительного синтеза: PREFETCH:base64_текст|параметры
+        if line.upper().startswith("PREFETCH:"):
+            parts = line[len("PREFETCH:"):].split('|')
+            request_id = None
+            try:
+                if len(parts) > 2:
+                    raise ValueError("Неверный формат команды. Ожидается: PREFETCH:base64_текст|параметры")
+                params = parse_params(parts[1]) if len(parts) == 2 else {}
+                request_id = params.pop('id', None)
+                yield "prefetch", request_id, (decode_base64_text(parts[0]), "", params)
+            except ValueError as e:
+                yield "error", request_id, str(e)
+            continue
+
+        if line.upper().startswith("RELEASE:"):
+            try:
+                yield "release", None, int(line[len("RELEASE:"):])
+            except ValueError:
+                yield "error", None, f"Неверный номер слота: {line[len('RELEASE:'):]}"
+            continue
+
+        # Парсим команду: base64_текст|путь|параметры, base64_текст|путь или просто base64_текст
+        parts = line.split('|')
+
+        if len(parts) > 3:
+            # Лишний | (например, в пути): id ищем в последнем поле, чтобы клиент получил ответ на свой запрос
+            request_id = find_request_id(parts[-1])
+            yield "error", request_id, "Неверный формат команды. Ожидается: base64_текст|путь или base64_текст"
+            continue
+
+        request_id = None
+        try:
+            params = parse_params(parts[2]) if len(parts) == 3 else {}
+            # id известен до декодирования текста: ошибку base64 клиент сопоставит со своим запросом
+            request_id = params.pop('id', None)
+            # Декодируем base64 сразу, чтобы найти дубликаты
+            text = decode_base64_text(parts[0])
+        except ValueError as e:
+            yield "error", request_id, str(e)
+            continue
+
+        output_path = parts[1] if len(parts) > 1 else ""
+        yield "synthesize", request_id, (text, output_path, params)
+
+
+# Заголовок двоичного кадра: тип, флаги, резерв, id запроса, длины текста, пути и параметров (UTF-8)
+BINARY_FRAME_HEADER = struct.Struct('<BBHIIII')
+FRAME_SYNTHESIZE = 0
+FRAME_EXIT = 1
+FRAME_RELEASE = 2  # номер слота передается в поле id
+FRAME_PREFETCH = 3  # путь не используется
+# Наибольший размер данных кадра: поврежденный заголовок не должен заставить читать гигабайты
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+def _read_exact(stream, view):
+    """Заполняет memoryview целиком; False, если поток закончился"""
+    filled = 0
+    while filled < len(view):
+        count = stream.readinto(view[filled:])
+        if not count:
+            return False
+        filled += count
+    return True
+
+
+def iter_binary_commands(stream):
+    """Разбирает двоичный протокол: заголовок фиксированной длины и сырые UTF-8 данные без base64
+
+    Выдает кортежи (команда, id запроса, данные), как iter_text_commands.
+    """
+    header = bytearray(BINARY_FRAME_HEADER.size)
+    header_view = memoryview(header)
+    # Буфер данных переиспользуется между кадрами и растет только при необходимости
+    payload = bytearray(64 * 1024)
+
+    while _read_exact(stream, header_view):
+        kind, flags, _, request_id, text_length, path_length, params_length = BINARY_FRAME_HEADER.unpack(header)
+        size = text_length + path_length + params_length
+        if size > MAX_FRAME_SIZE:
+            # Границы следующих кадров неизвестны, поэтому дальше поток не разбираем
+            yield "error", request_id, f"Размер кадра {size} байт больше допустимого ({MAX_FRAME_SIZE}), чтение команд остановлено"
+            return
+        if size > len(payload):
+            payload = bytearray(size)
+        view = memoryview(payload)
+        if not _read_exact(stream, view[:size]):
+            break
+
+        if kind == FRAME_EXIT:
+            yield "exit", request_id, None
+            return
+
+        if kind == FRAME_RELEASE:
+            yield "release", request_id, request_id
+            continue
+
+        if kind not in (FRAME_SYNTHESIZE, FRAME_PREFETCH):
+            yield "error", request_id, f"Неизвестный тип кадра: {kind}"
+            continue
+
+        try:
+            text = str(view[:text_length], 'utf-8')
+            output_path = str(view[text_length:text_length + path_length], 'utf-8')
+            params = parse_params(str(view[text_length + path_length:size], 'utf-8'))
+        except (UnicodeDecodeError, ValueError) as e:
+            yield "error", request_id, f"Ошибка разбора кадра: {e}"
+            continue
+
+        yield "prefetch" if kind == FRAME_PREFETCH else "synthesize", request_id, (text, output_path, params)
+
+
+def find_request_id(params_text):
+    """id запроса из поля параметров, которое целиком разобрать не удалось; None, если его нет"""
+    for item in params_text.split(';'):
+        key, separator, value = item.partition('=')
+        if separator and key.strip() == 'id':
+            return value.strip()
+    return None
+
+
+def parse_params(params_text):
+    """Разбирает параметры задачи вида key=value;key=value"""
+    params = {}
+    for item in params_text.split(';'):
+        item = item.strip()
+        if not item:
+            continue
+        key, separator, value = item.partition('=')
+        if not separator:
+            raise ValueError(f"Неверный параметр '{item}'. Ожидается: ключ=значение")
+        params[key.strip()] = value.strip()
+    return params
+
+
+class SegmentedWavWriter:
+    """Дописывает PCM в растущий WAV файл или разбивает его на пронумерованные сегменты"""
+
+    def __init__(self, output_path, sample_rate, segment_duration=None):
+        self.output_path = Path(output_path)
+        self.sample_rate = sample_rate
+        self.segment_frames = int(segment_duration * sample_rate) if segment_duration else None
+        self.paths = []
+        self._wav_file = None
+        self._frames = 0
+
+    def _segment_path(self):
+        if self.segment_frames is None:
+            return self.output_path
+        index = len(self.paths) + 1
+        return self.output_path.with_name(f"{self.output_path.stem}_{index:04d}{self.output_path.suffix}")
+
+    def _open(self):
+        path = self._segment_path()
+        if path.parent and not path.parent.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+        self._wav_file = wave.open(str(path), 'wb')
+        self._wav_file.setnchannels(1)  # моно
+        self._wav_file.setsampwidth(2)  # 16-бит
+        self._wav_file.setframerate(self.sample_rate)
+        self._frames = 0
+        self.paths.append(path)
+
+    def write(self, audio_bytes):
+        """Дописывает аудио и возвращает список закрытых сегментов"""
+        if self._wav_file is None:
+            self._open()
+        # wave обновляет заголовок после каждой записи, поэтому файл читаем в любой момент
+        self._wav_file.writeframes(audio_bytes)
+        self._frames += len(audio_bytes) // 2
+
+        # Сегмент закрываем только на границе предложения/фрагмента
+        if self.segment_frames is not None and self._frames >= self.segment_frames:
+            return self.close()
+        return []
+
+    def close(self):
+        """Закрывает текущий сегмент и возвращает его путь"""
+        if self._wav_file is None:
+            return []
+        self._wav_file.close()
+        self._wav_file = None
+        return [self.paths[-1]]
+
+
+def positive_int(value):
+    """Тип argparse: положительное целое (0 не должен молча означать «все ядра»)"""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"ожидается положительное целое: {value}")
+    return number
+
+
+def positive_int_list(value):
+    """Тип argparse: список положительных целых через запятую"""
+    try:
+        numbers = [int(item) for item in value.split(',') if item.strip()]
+    except ValueError:
+        numbers = []
+    if not numbers or any(number <= 0 for number in numbers):
+        raise argparse.ArgumentTypeError(f"ожидаются положительные целые через запятую: {value}")
+    return numbers
+
+
+def tune_main(argv):
+    """Подкоманда tune: подбирает число рабочих процессов и потоков onnxruntime и сохраняет профиль"""
+    parser = argparse.ArgumentParser(prog="main.py tune",
+                                     description="Автонастройка рабочих процессов и потоков onnxruntime")
+    parser.add_argument("-l", "--language", default="ru", help="Язык модели (по умолчанию: ru)")
+    parser.add_argument("--models-dir", help="Папка с моделями")
+    parser.add_argument("--max-workers", type=positive_int, help="Наибольшее число рабочих процессов (по умолчанию: число ядер)")
+    parser.add_argument("--threads-options", metavar="N,N,...", type=positive_int_list,
+                        help="Проверяемые числа потоков через запятую (по умолчанию: степени двойки до числа ядер)")
+    parser.add_argument("--texts", type=positive_int, default=16, help="Фраз на каждое сочетание (по умолчанию: 16)")
+    parser.add_argument("--max-p95-ms", type=float, help="Допустимое p95 времени синтеза фразы в мс")
+    parser.add_argument("--profile", help="Файл профиля (по умолчанию: TTS_PROFILE или папка настроек пользователя)")
+    parser.add_argument("--dry-run", action="store_true", help="Только показать результаты, не сохраняя профиль")
+    args = parser.parse_args(argv)
+
+    try:
+        model_path, config_path = TTSEngine(args.models_dir).model_paths(args.language)
+    except FileNotFoundError as e:
+        safe_print(f"Ошибка: {e}")
+        return
+
+    configs = candidate_configs(max_workers=args.max_workers, thread_options=args.threads_options)
+
+    safe_print("=== TTS Автонастройка ===")
+    safe_print(f"Модель: {model_path}")
+    safe_print(f"Ядер: {os.cpu_count()}, сочетаний: {len(configs)}, фраз на сочетание: {args.texts}")
+    sys.stdout.flush()
+
+    def report(result):
+        safe_print(f"workers={result['workers']} threads={result['threads']}: "
+                   f"{result['texts_per_second']} фраз/с, {result['audio_per_second']} с аудио/с, "
+                   f"p95 {result['p95_ms']} мс")
+        sys.stdout.flush()
+
+    try:
+        _, profile = tune(model_path, config_path, args.language, configs, args.texts, args.max_p95_ms, report)
+    except RuntimeError as e:
+        safe_print(f"Ошибка: {e}")
+        return
+    safe_print(f"Лучшее сочетание: workers={profile['workers']} threads={profile['threads']}")
+
+    if not args.dry_run:
+        profile_path = save_profile(model_path, profile, args.profile)
+        safe_print(f"Профиль сохранен: {profile_path}")
+    safe_print("=== TTS Автонастройка завершена ===")
+
+
+def phonemize_main(argv):
+    """Подкоманда phonemize: переводит каталог текстов в двоичный корпус id фонем модели"""
+    parser = argparse.ArgumentParser(prog="main.py phonemize",
+                                     description="Фонемизация каталога в двоичный корпус для синтеза без espeak")
+    parser.add_argument("catalog", help="Каталог: JSON Lines {\"id\": ..., \"text\": ...} или строки id<TAB>текст")
+    parser.add_argument("-o", "--output", help="Файл корпуса (по умолчанию: имя каталога с расширением .phon)")
+    parser.add_argument("-l", "--language", default="ru", help="Язык модели (по умолчанию: ru)")
+    parser.add_argument("--models-dir", help="Папка с моделями")
+    args = parser.parse_args(argv)
+
+    output_path = Path(args.output) if args.output else Path(args.catalog).with_suffix(".phon")
+    try:
+        _, config_path = TTSEngine(args.models_dir).model_paths(args.language)
+        started = time.time()
+        entries, sentences, ids = compile_corpus(read_catalog(args.catalog), config_path, output_path)
+    except (OSError, ValueError, KeyError) as e:
+        safe_print(f"Ошибка: {e}")
+        return
+
+    safe_print(f"Записей: {entries}, предложений: {sentences}, id фонем: {ids}")
+    safe_print(f"Размер корпуса: {output_path.stat().st_size:,} байт, время: {time.time() - started:.2f} сек")
+    safe_print(f"Корпус сохранен: {output_path.absolute()}")
+
+
+def synthesize_corpus(tts, language, output_dir=None):
+    """Синтезирует все записи корпуса в output_dir/<id>.wav"""
+    output_dir = Path(output_dir or ".")
+    for entry_id in tts.corpus.ids():
+        output_path = output_dir / f"{entry_id}.wav"
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        audio, sample_rate = tts.synthesize_audio(f"[{entry_id}]", language, phoneme_ids=tts.corpus.entry(entry_id))
+        tts.save_wav(audio, sample_rate, output_path)
+        safe_print(f"SUCCESS:{output_path.absolute()}")
+        sys.stdout.flush()
+
+
 def main():
+    # Подкоманды проверяем до разбора основных аргументов, где первый позиционный аргумент — текст
+    if len(sys.argv) > 1 and sys.argv[1] == "tune":
+        tune_main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "phonemize":
+        phonemize_main(sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser(description="TTS с использованием Piper")
     parser.add_argument("text", nargs="?", help="Текст для синтеза речи")
     parser.add_argument("-l", "--language", default="ru", help="Язык модели (по умолчанию: ru)")
     parser.add_argument("-o", "--output", help="Имя выходного WAV файла или директория для потокового режима")
     parser.add_argument("--list-models", action="store_true", help="Показать доступные модели")
+    parser.add_argument("--models-dir",
+                        help="Папка с моделями (по умолчанию: переменная TTS_MODELS_DIR, models рядом с exe или встроенные)")
     parser.add_argument("--base64", action="store_true", help="Входной текст закодирован в base64")
     parser.add_argument("--stream", action="store_true", help="Потоковый режим: читать команды из stdin")
+    parser.add_argument("--shm-slots", type=int, default=0,
+                        help="Потоковый режим: число слотов разделяемой памяти для выдачи аудио (по умолчанию выключено)")
+    parser.add_argument("--shm-slot-size", type=int, default=2 * 1024 * 1024,
+                        help="Размер слота разделяемой памяти в байтах (по умолчанию 2 МБ)")
+    parser.add_argument("--input-framing", choices=["text", "binary"], default="text",
+                        help="Потоковый режим: формат команд в stdin (text — base64 строки, binary — двоичные кадры)")
+    parser.add_argument("--prefetch-cache", type=int, default=32,
+                        help="Потоковый режим: сколько результатов PREFETCH хранить в памяти (0 — отключить)")
+    parser.add_argument("--worker-process", action="store_true",
+                        help="Потоковый режим: синтез в отдельном перезапускаемом процессе")
+    parser.add_argument("--task-timeout", type=float,
+                        help="Максимальное время синтеза одной задачи в секундах (включает --worker-process)")
+    parser.add_argument("--recycle-after", type=int,
+                        help="Перезапускать рабочий процесс после N задач (включает --worker-process)")
+    parser.add_argument("--max-rss-mb", type=float,
+                        help="Перезапускать рабочий процесс при превышении памяти в МБ (включает --worker-process)")
+    parser.add_argument("--task-retries", type=int, default=1,
+                        help="Число повторов задачи после аварийного завершения рабочего процесса (по умолчанию: 1)")
+    parser.add_argument("--spool", metavar="DIR",
+                        help="Режим очереди в общей папке: обрабатывать задания DIR/incoming/*.json")
+    parser.add_argument("--spool-lease", type=float, default=300.0,
+                        help="Через сколько секунд без продления задание умершего обработчика возвращается в очередь")
+    parser.add_argument("--spool-poll", type=float, default=1.0,
+                        help="Интервал проверки новых заданий в секундах (по умолчанию: 1)")
+    parser.add_argument("--spool-max-attempts", type=int, default=3,
+                        help="Сколько раз задание может быть захвачено, прежде чем оно считается неудачным")
+    parser.add_argument("--spool-once", action="store_true",
+                        help="Завершиться, когда в incoming/ не останется заданий")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Инкрементальный режим: читать текст из stdin и озвучивать по предложениям")
+    parser.add_argument("--segment-duration", type=float,
+                        help="Длительность сегмента в секундах для инкрементального режима (по умолчанию один файл)")
+    parser.add_argument("--trim-silence", action="store_true", help="Обрезать тишину в начале и в конце")
+    parser.add_argument("--silence-threshold", type=float, default=-50.0,
+                        help="Порог тишины в dBFS для --trim-silence (по умолчанию: -50)")
+    parser.add_argument("--normalize", type=float, metavar="DBFS",
+                        help="Нормализовать громкость (RMS) к указанному уровню в dBFS, например -20")
+    parser.add_argument("--sample-rate", type=int, help="Передискретизировать аудио в указанную частоту, например 48000")
+    parser.add_argument("--sentence-cache", action="store_true",
+                        help="Кэшировать аудио отдельных предложений и синтезировать только новые")
+    parser.add_argument("--sentence-cache-mb", type=positive_int, default=64,
+                        help="Сколько мегабайт аудио предложений хранить в памяти (по умолчанию: 64)")
+    parser.add_argument("--sentence-cache-dir",
+                        help="Папка для кэша предложений на диске (включает --sentence-cache)")
+    parser.add_argument("--sentence-silence", type=float, default=0.0,
+                        help="Пауза между склеенными предложениями в секундах (по умолчанию: 0)")
+    parser.add_argument("--corpus", help="Корпус фонем (python main.py phonemize): синтез записей без espeak")
+    parser.add_argument("--entry", help="Id записи корпуса для синтеза (без --entry — все записи в папку -o)")
+    parser.add_argument("--workers", type=positive_int,
+                        help="Потоковый режим: число рабочих процессов синтеза (по умолчанию: из профиля или 1)")
+    parser.add_argument("--threads", type=positive_int,
+                        help="Потоков onnxruntime на модель (по умолчанию: из профиля или все ядра)")
+    parser.add_argument("--profile", help="Файл профиля автонастройки (по умолчанию: TTS_PROFILE или папка настроек)")
+    parser.add_argument("--no-profile", action="store_true", help="Не загружать профиль автонастройки")
 
     args = parser.parse_args()
 
     # Создаем экземпляр TTS процессора
-    tts = TTSProcessor()
+    tts = TTSProcessor(args.models_dir)
+    try:
+        tts.post_processor = PostProcessor(
+            trim_silence=args.trim_silence,
+            silence_threshold=args.silence_threshold,
+            normalize=args.normalize,
+            sample_rate=args.sample_rate
+        )
+    except ValueError as e:
+        parser.error(str(e))
+    sentence_cache_options = None
+    if args.sentence_cache or args.sentence_cache_dir:
+        sentence_cache_options = {
+            'max_bytes': args.sentence_cache_mb * 1024 * 1024,
+            'cache_dir': args.sentence_cache_dir,
+            'sentence_silence': args.sentence_silence
+        }
+        tts.sentence_cache = SentenceCache(**sentence_cache_options)
 
     # Показываем доступные модели
     if args.list_models:
         tts.list_available_models()
         return
 
-    # Потоковый режим
+    # Профиль автонастройки (python main.py tune) для этой машины и модели; аргументы важнее профиля
+    profile = None
+    if not args.no_profile:
+        try:
+            profile = load_profile(tts.engine.model_paths(args.language)[0], args.profile)
+        except FileNotFoundError:
+            pass  # Об отсутствии модели сообщит выбранный режим
+    if profile:
+        safe_print(f"Профиль автонастройки: workers={profile['workers']} threads={profile['threads']}")
+    workers = args.workers or (profile['workers'] if profile else 1)
+    tts.engine.threads = args.threads or (profile['threads'] if profile else None)
+
+    def make_supervisor():
+        return SynthesisSupervisor(
+            tts.models_dir,
+            args.language,
+            task_timeout=args.task_timeout,
+            recycle_after=args.recycle_after,
+            max_rss_mb=args.max_rss_mb,
+            task_retries=args.task_retries,
+            sentence_cache_options=sentence_cache_options,
+            threads=tts.engine.threads
+        )
+
+    supervisor = None
+    if args.spool and (args.worker_process or args.task_timeout or args.recycle_after or args.max_rss_mb):
+        supervisor = make_supervisor()
+
+    if args.corpus:
+        try:
+            tts.load_corpus(args.corpus, args.language)
+        except (OSError, ValueError) as e:
+            safe_print(f"Ошибка: {e}")
+            return
+
+    # Режим очереди в общей папке
+    if args.spool:
+        tts.spool_mode(
+            args.spool,
+            default_language=args.language,
+            lease_timeout=args.spool_lease,
+            poll_interval=args.spool_poll,
+            max_attempts=args.spool_max_attempts,
+            once=args.spool_once,
+            supervisor=supervisor
+        )
+        return
+
+    # Потоковый режим: несколько рабочих процессов работают параллельно, каждый со своей сессией
     if args.stream:
+        supervisors = []
+        if workers > 1 or args.worker_process or args.task_timeout or args.recycle_after or args.max_rss_mb:
+            supervisors = [make_supervisor() for _ in range(workers)]
         tts.stream_mode(
-            default_language=args.language
+            default_language=args.language,
+            shm_slots=args.shm_slots,
+            shm_slot_size=args.shm_slot_size,
+            supervisors=supervisors,
+            input_framing=args.input_framing,
+            prefetch_cache=args.prefetch_cache
         )
         return
 
+    # Инкрементальный режим
+    if args.incremental:
+        try:
+            tts.narrate(sys.stdin.buffer, args.language, args.output, args.segment_duration)
+        except KeyboardInterrupt:
+            safe_print("\nПолучен сигнал прерывания. Завершаю работу...")
+        except Exception as e:
+            safe_print(f"Ошибка при синтезе речи: {e}")
+        return
+
+    # Синтез записей корпуса фонем: одной (--entry) или всех в папку -o
+    if args.corpus:
+        try:
+            if args.entry is not None:
+                output_file = tts.text_to_speech(f"[{args.entry}]", args.language, args.output or f"{args.entry}.wav",
+                                                 phoneme_ids=tts.corpus_entry(args.entry))
+                safe_print(f"\nГотово! Аудио файл: {output_file}")
+            else:
+                synthesize_corpus(tts, args.language, args.output)
+        except (OSError, ValueError) as e:
+            safe_print(f"Ошибка: {e}")
+        return
+
     # Проверяем, что передан текст
     if not args.text:
         safe_print("Ошибка: Не указан текст для синтеза")
@@ -308,7 +1657,7 @@ def main():
 
     except FileNotFoundError as e:
         safe_print(f"Ошибка: {e}")
-        safe_print(f"\nУбедитесь, что в папке models/ есть файлы:")
+        safe_print(f"\nУбедитесь, что в папке {tts.models_dir} есть файлы:")
         safe_print(f"  - {args.language}.onnx")
         safe_print(f"  - {args.language}.onnx.json")
         safe_print("\nДля просмотра доступных моделей: python main.py --list-models")
@@ -318,4 +1667,6 @@ def main():
 
 
 if __name__ == '__main__':
+    # Нужно для рабочих процессов в собранном PyInstaller exe
+    multiprocessing.freeze_support()
     main()
@@ -1,34 +1,20 @@
 ﻿#!/usr/bin/env python3
-import subprocess
-import base64
 import time
 import os
 
+from tts_client import TTSClient, TTSError
+
 # Получаем директорию проекта (где находится этот скрипт)
 PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
 
 print("=" * 70)
 print("=== PERFORMANCE TEST: TTS Stream Mode ===")
 print("=" * 70)
-print(f"Project directory: {PROJECT_DIR}\n")
-
-# Запускаем процесс
-start_init = time.time()
-process = subprocess.Popen(
-    ['python', 'main.py', '--stream', '-l', 'ru'],
-    stdin=subprocess.PIPE,
-    stdout=subprocess.PIPE,
-    stderr=subprocess.PIPE,
-    text=True,
-    encoding='utf-8',
-    bufsize=1,
-    cwd=PROJECT_DIR  # Запускаем в директории проекта
-)
-
-print("Starting TTS process in stream mode...")
-time.sleep(2)
-init_time = time.time() - start_init
-print(f"✓ Initialization completed: {init_time:.2f}s\n")
+print(f"Project directory: {PROJECT_DIR}")
+
+# Собранный exe можно проверить так: TTS_COMMAND=dist/tts/tts python performance_test.py
+TTS_COMMAND = os.environ.get('TTS_COMMAND')
+print(f"TTS command: {TTS_COMMAND or 'python main.py'}\n")
 
 # ДЛИННЫЕ тестовые тексты для реалистичной проверки
 test_cases = [
@@ -86,47 +72,57 @@ test_cases = [
     ),
 ]
 
+WARMUP_PATH = os.path.join(PROJECT_DIR, "perf_warmup.wav")
+
 # Статистика
 command_timings = []
 total_chars = 0
-queue_start_time = time.time()
+client = None
 
 try:
+    # Запускаем процесс (клиент ждет готовности вместо фиксированной паузы)
+    print("Starting TTS process in stream mode...")
+    start_init = time.time()
+    client = TTSClient(
+        language='ru',
+        command=[TTS_COMMAND] if TTS_COMMAND else None,
+        cwd=PROJECT_DIR  # Запускаем в директории проекта
+    )
+    launch_time = time.time() - start_init
+    print(f"✓ Launch completed (process start -> READY): {launch_time:.2f}s")
+
+    # Холодный старт: запуск + загрузка модели + короткая фраза
+    client.synthesize("Прогрев.", WARMUP_PATH, timeout=120)
+    init_time = time.time() - start_init
+    print(f"✓ Initialization completed (launch + model load + first phrase): {init_time:.2f}s\n")
+
+    queue_start_time = time.time()
     print("=" * 70)
     print("SENDING COMMANDS TO QUEUE")
     print("=" * 70)
 
-    # Отправляем все команды
+    # Отправляем все команды без ожидания: каждая возвращает future
     for i, (text, path) in enumerate(test_cases, 1):
-        text_b64 = base64.b64encode(text.encode('utf-8')).decode('ascii')
         total_chars += len(text)
 
-        if path:
-            command = f"{text_b64}|{path}\n"
-            print(f"\n[Command {i}]")
-            print(f"  Text length: {len(text)} characters")
-            print(f"  Output path: {path}")
-        else:
-            command = f"{text_b64}\n"
-            print(f"\n[Command {i}]")
-            print(f"  Text length: {len(text)} characters")
-            print(f"  Output path: (auto-generated)")
+        print(f"\n[Command {i}]")
+        print(f"  Text length: {len(text)} characters")
+        print(f"  Output path: {path if path else '(auto-generated)'}")
 
         # Замеряем время добавления в очередь
         cmd_start = time.time()
-        process.stdin.write(command)
-        process.stdin.flush()
+        future = client.submit(text, path or "")
         cmd_time = time.time() - cmd_start
 
         command_timings.append({
             'index': i,
             'chars': len(text),
             'queue_time_ms': cmd_time * 1000,
-            'queued_at': time.time()
+            'queued_at': cmd_start,
+            'future': future
         })
 
         print(f"  Queue time: {cmd_time*1000:.3f}ms")
-        time.sleep(0.05)
 
     queue_total_time = time.time() - queue_start_time
 
@@ -137,51 +133,36 @@ try:
     print("\nWaiting for processing to complete...")
     print("(This may take a while for long texts)\n")
 
-    # Даем время на обработку (больше для длинных текстов)
-    processing_start = time.time()
-    time.sleep(15)
-
-    # Отправляем команду выхода
-    print("Sending 'exit' command...")
-    exit_start = time.time()
-    process.stdin.write("exit\n")
-    process.stdin.flush()
-    process.stdin.close()
+    # Ждем ответ на каждую команду: время завершения — момент прихода SUCCESS/ERROR
+    print("=" * 70)
+    print("=== RESULTS ===")
+    print("=" * 70)
+    for timing in command_timings:
+        try:
+            result = timing['future'].result(timeout=120)
+            status = f"SUCCESS:{result}"
+        except TTSError as e:
+            status = f"ERROR:{e}"
+        timing['latency'] = time.time() - timing['queued_at']
+        print(f"  [Command {timing['index']}] {timing['latency']:.3f}s  {status}")
 
-    # Читаем весь вывод
-    stdout, stderr = process.communicate(timeout=20)
-    exit_time = time.time() - exit_start
     total_time = time.time() - start_init
     processing_time = total_time - init_time
 
+    # Отправляем команду выхода
+    print("\nSending 'exit' command...")
+    exit_start = time.time()
+    client.close()
+    client = None
+    exit_time = time.time() - exit_start
     print(f"Exit completed in {exit_time:.2f}s\n")
 
-    # Парсим вывод для извлечения SUCCESS сообщений
-    success_times = []
-    if stdout:
-        for line in stdout.split('\n'):
-            if 'SUCCESS:' in line:
-                success_times.append(time.time())
-
-    print("=" * 70)
-    print("=== TTS PROCESS OUTPUT ===")
-    print("=" * 70)
-    if stdout:
-        # Показываем только важные строки
-        for line in stdout.split('\n'):
-            line_stripped = line.strip()
-            if any(keyword in line_stripped for keyword in ['QUEUED:', 'SUCCESS:', 'ERROR:', '===', 'Model']):
-                print(line)
-
-    if stderr and stderr.strip():
-        print("\n=== STDERR ===")
-        print(stderr)
-
     # ДЕТАЛЬНАЯ СТАТИСТИКА ПРОИЗВОДИТЕЛЬНОСТИ
     print(f"\n{'=' * 70}")
     print("=== PERFORMANCE STATISTICS ===")
     print("=" * 70)
     print(f"\n┌─ TIMING BREAKDOWN")
+    print(f"│  Launch time:             {launch_time:.3f}s")
     print(f"│  Initialization time:     {init_time:.3f}s")
     print(f"│  Queue setup time:        {queue_total_time:.3f}s")
     print(f"│  Processing time:         {processing_time:.3f}s")
@@ -195,6 +176,7 @@ try:
     print(f"│  Time per character:      {(processing_time / total_chars) * 1000:.3f}ms")
     print(f"│  Commands processed:      {len(test_cases)}")
     print(f"│  Avg time per command:    {processing_time / len(test_cases):.3f}s")
+    print(f"│  Max request latency:     {max(t['latency'] for t in command_timings):.3f}s")
     print(f"└─")
 
     # Проверяем созданные файлы
@@ -255,7 +237,6 @@ try:
         print(f"│  Bytes per second:        {total_size / processing_time:,.0f} B/s ({total_size/processing_time/1024:.1f} KB/s)")
         print(f"│  Audio per character:     {total_size / total_chars:.1f} bytes/char")
     print(f"│  Success rate:            {(files_created/len(test_cases))*100:.0f}%")
-    print(f"│  Exit code:               {process.returncode}")
     print(f"└─")
 
     # РЕКОМЕНДАЦИИ
@@ -280,23 +261,23 @@ try:
 
     print(f"\n{'=' * 70}")
 
-except subprocess.TimeoutExpired:
+except TimeoutError:
     print("\n⚠ TIMEOUT! Process took too long to complete.")
-    process.kill()
-    stdout, stderr = process.communicate()
-    if stdout:
-        print("\nPartial output:")
-        print(stdout[-500:])  # Last 500 chars
 
 except KeyboardInterrupt:
     print("\n⚠ Test interrupted by user!")
-    process.kill()
 
 except Exception as e:
     print(f"\n❌ ERROR: {e}")
     import traceback
     traceback.print_exc()
-    process.kill()
+
+finally:
+    # Процесс TTS не должен пережить тест, даже если он не запустился или упал на прогреве
+    if client is not None:
+        client.close()
+    if os.path.exists(WARMUP_PATH):
+        os.remove(WARMUP_PATH)
 
 print("\n" + "=" * 70)
 print("=== TEST COMPLETED ===")
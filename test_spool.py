@@ -0,0 +1,62 @@
+﻿#!/usr/bin/env python3
+import json
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+print("=== Тест режима очереди в общей папке ===\n")
+
+test_texts = [
+    "Первое задание из очереди",
+    "Второе задание из очереди",
+    "Третье задание из очереди",
+    "Четвертое задание из очереди",
+    "Пятое задание из очереди",
+    "Шестое задание из очереди"
+]
+
+spool_dir = Path(tempfile.mkdtemp(prefix="tts_spool_"))
+incoming = spool_dir / "incoming"
+incoming.mkdir(parents=True)
+
+print(f"Папка очереди: {spool_dir}\n")
+for i, text in enumerate(test_texts, 1):
+    job = {"text": text, "output": f"output/spool_test{i}.wav", "params": {"normalize": -16}}
+    (incoming / f"job{i}.json").write_text(json.dumps(job, ensure_ascii=False), encoding='utf-8')
+    print(f"[Задание {i}] {text}")
+
+# Несколько обработчиков разбирают одну папку, как процессы на разных хостах
+print("\nЗапускаю 3 обработчика...\n")
+workers = [
+    subprocess.Popen(
+        [sys.executable, 'main.py', '--spool', str(spool_dir), '--spool-once', '-l', 'ru'],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        encoding='utf-8'
+    )
+    for _ in range(3)
+]
+
+for n, worker in enumerate(workers, 1):
+    stdout, stderr = worker.communicate(timeout=300)
+    processed = [line for line in stdout.splitlines() if line.startswith("SUCCESS:")]
+    print(f"Обработчик {n}: выполнено заданий {len(processed)}")
+    if stderr.strip():
+        print(f"  stderr: {stderr.strip()[-300:]}")
+
+print("\nРезультаты:")
+done = sorted((spool_dir / "done").glob("*.json"))
+failed = sorted((spool_dir / "failed").glob("*.json"))
+for job_file in done:
+    result = json.loads(job_file.read_text(encoding='utf-8'))['result']
+    exists = "✓" if Path(result['output']).exists() else "✗"
+    print(f"  {exists} {job_file.name} -> {result['output']} ({result['worker']}, {result['duration']} сек)")
+for job_file in failed:
+    result = json.loads(job_file.read_text(encoding='utf-8')).get('result', {})
+    print(f"  ✗ {job_file.name}: {result.get('error')}")
+
+print(f"\nВыполнено: {len(done)} из {len(test_texts)}, ошибок: {len(failed)}")
+print(f"Осталось в incoming/: {len(list(incoming.glob('*.json')))}")
+print(f"Осталось в processing/: {len(list((spool_dir / 'processing').glob('*.claim')))}")
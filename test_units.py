@@ -0,0 +1,642 @@
+﻿#!/usr/bin/env python3
+"""Модульные тесты логики, которой не нужна модель: python -m unittest test_units"""
+import asyncio
+import base64
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from contextlib import redirect_stdout
+from pathlib import Path
+from threading import Event, Lock, Thread, current_thread
+
+import numpy as np
+
+from main import (
+    BINARY_FRAME_HEADER, FRAME_EXIT, FRAME_PREFETCH, FRAME_RELEASE, FRAME_SYNTHESIZE, MAX_FRAME_SIZE,
+    PrefetchStore, SpoolDirectory, StreamScheduler, iter_binary_commands, iter_text_commands
+)
+from tts_api import LinearResampler, PostProcessor, SentenceCache, iter_sentences
+from tts_client import AsyncTTSClient, parse_shm_result
+from tts_corpus import PhonemeCorpus, compile_corpus, config_checksum, read_catalog
+from tts_tune import candidate_configs, hardware_id, load_profile, model_id, save_profile, select_best
+
+# Для корпуса фонем нужна только конфигурация модели, сама модель не загружается
+CONFIG_PATH = Path(__file__).parent / "models" / "ru.onnx.json"
+
+
+class SpoolDirectoryTest(unittest.TestCase):
+    """Захват, аренда, возврат в очередь и завершение заданий в общей папке"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.temp_dir.name)
+        self.worker_a = SpoolDirectory(self.root, lease_timeout=60)
+        self.worker_b = SpoolDirectory(self.root, lease_timeout=60)
+        self.worker_a.worker_id = "host-a:1"
+        self.worker_b.worker_id = "host-b:2"
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def add_job(self, name, job):
+        path = self.root / "incoming" / name
+        path.write_text(json.dumps(job, ensure_ascii=False), encoding='utf-8')
+        return path
+
+    def expire_lease(self, job_path):
+        os.utime(job_path, (0, 0))
+
+    def test_job_is_claimed_once(self):
+        self.add_job("job1.json", {"text": "Привет"})
+        job_path, job = self.worker_a.claim_next()
+        self.assertIsNone(self.worker_b.claim_next())
+        self.assertEqual(SpoolDirectory.job_name(job_path), "job1.json")
+        self.assertEqual(job['claimed_by'], "host-a:1")
+        self.assertEqual(job['attempts'], 1)
+
+    def test_complete_moves_job_with_result(self):
+        self.add_job("job1.json", {"text": "Привет"})
+        job_path, job = self.worker_a.claim_next()
+        self.assertTrue(self.worker_a.complete(job_path, job, {'status': 'done', 'output': 'a.wav'}))
+        result = json.loads((self.root / "done" / "job1.json").read_text(encoding='utf-8'))
+        self.assertEqual(result['result']['output'], 'a.wav')
+        self.assertEqual(list((self.root / "processing").iterdir()), [])
+        self.assertEqual([path.name for path in (self.root / "done").iterdir()], ["job1.json"])
+
+    def test_fresh_lease_is_not_reclaimed(self):
+        self.add_job("job1.json", {"text": "Привет"})
+        self.worker_a.claim_next()
+        self.assertEqual(self.worker_b.reclaim_stale(), [])
+
+    def test_stale_owner_cannot_complete(self):
+        self.add_job("job1.json", {"text": "Привет"})
+        path_a, job_a = self.worker_a.claim_next()
+        self.expire_lease(path_a)
+
+        self.assertEqual(self.worker_b.reclaim_stale(), ["job1.json"])
+        path_b, job_b = self.worker_b.claim_next()
+        self.assertEqual(job_b['attempts'], 2)
+
+        self.assertFalse(self.worker_a.complete(path_a, job_a, {'status': 'done', 'output': 'a.wav'}))
+        self.assertTrue(self.worker_b.complete(path_b, job_b, {'status': 'done', 'output': 'b.wav'}))
+        result = json.loads((self.root / "done" / "job1.json").read_text(encoding='utf-8'))
+        self.assertEqual(result['claimed_by'], "host-b:2")
+        self.assertEqual(result['result']['output'], 'b.wav')
+
+    def test_invalid_job_is_moved_unchanged(self):
+        self.add_job("bad.json", {"output": "a.wav"})
+        (self.root / "incoming" / "broken.json").write_text("{", encoding='utf-8')
+        self.assertIsNone(self.worker_a.claim_next())
+        self.assertEqual((self.root / "failed" / "broken.json").read_text(encoding='utf-8'), "{")
+        self.assertTrue((self.root / "failed" / "bad.json").exists())
+
+    def test_max_attempts(self):
+        spool = SpoolDirectory(self.root, lease_timeout=60, max_attempts=1)
+        self.add_job("job1.json", {"text": "Привет", "attempts": 1})
+        self.assertIsNone(spool.claim_next())
+        result = json.loads((self.root / "failed" / "job1.json").read_text(encoding='utf-8'))
+        self.assertEqual(result['result']['status'], 'failed')
+
+    def test_default_output_uses_job_name(self):
+        self.add_job("job1.json", {"text": "Привет"})
+        job_path, job = self.worker_a.claim_next()
+        self.assertEqual(self.worker_a.output_path(job_path, None), self.root / "output" / "job1.wav")
+
+
+class SentenceCacheTest(unittest.TestCase):
+    """Кэш предложений: ограничение памяти, параллельная запись и ошибки записи на диск"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = Path(self.temp_dir.name) / "cache"
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_parallel_writes_of_same_sentence(self):
+        cache = SentenceCache(cache_dir=self.cache_dir)
+        audio = np.arange(-25000, 25000, dtype=np.int16)
+        errors = []
+
+        def put():
+            try:
+                for _ in range(20):
+                    cache._put("модель\nПривет.", audio)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [Thread(target=put) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual([path.suffix for path in self.cache_dir.iterdir()], [".npy"])
+        np.testing.assert_array_equal(np.load(next(self.cache_dir.iterdir())), audio)
+
+    def test_write_error_is_not_fatal(self):
+        cache = SentenceCache(cache_dir=self.cache_dir)
+        shutil.rmtree(self.cache_dir)
+        with self.assertLogs('tts_api', level='WARNING'):
+            cache._put("модель\nПривет.", np.zeros(10, dtype=np.int16))
+        self.assertIsNotNone(cache._get("модель\nПривет."))
+
+    def test_memory_limit_in_bytes(self):
+        cache = SentenceCache(max_bytes=250)
+        for sentence in ("Один.", "Два.", "Три."):
+            cache._put(f"модель\n{sentence}", np.zeros(50, dtype=np.int16))  # по 100 байт
+        self.assertIsNone(cache._get("модель\nОдин."))
+        self.assertIsNotNone(cache._get("модель\nДва."))
+        cache._put("модель\nЧетыре.", np.zeros(50, dtype=np.int16))  # вытесняет "Три.": "Два." использован позже
+        self.assertIsNone(cache._get("модель\nТри."))
+        self.assertEqual(cache.memory_bytes, 200)
+        # Предложение больше всего кэша в памяти не остается
+        cache._put("модель\nДлинное.", np.zeros(200, dtype=np.int16))
+        self.assertEqual(cache.memory_bytes, 0)
+
+    def test_float32_files_are_converted(self):
+        cache = SentenceCache(cache_dir=self.cache_dir)
+        np.save(cache._file_path("модель\nПривет."), np.array([0.0, 0.5, -1.0], dtype=np.float32))
+        audio = cache._get("модель\nПривет.")
+        self.assertEqual(audio.dtype, np.int16)
+        np.testing.assert_array_equal(audio, [0, 16383, -32767])
+
+
+class LinearResamplerTest(unittest.TestCase):
+    """Передискретизация потока фрагментов совпадает с передискретизацией всего сигнала"""
+
+    def resample_chunks(self, source_rate, target_rate, audio, sizes):
+        resampler = LinearResampler(source_rate, target_rate)
+        parts = []
+        start = 0
+        for size in sizes:
+            parts.append(resampler.process(audio[start:start + size]))
+            start += size
+        parts.append(resampler.process(audio[start:]))
+        return np.concatenate(parts)
+
+    def test_tiny_chunks_when_downsampling(self):
+        audio = np.sin(np.arange(200, dtype=np.float32) / 7).astype(np.float32)
+        whole = LinearResampler(48000, 22050).process(audio)
+        chunked = self.resample_chunks(48000, 22050, audio, [5, 1, 1, 1, 2, 1, 30])
+        np.testing.assert_allclose(chunked, whole, atol=1e-6)
+
+    def test_chunks_when_upsampling(self):
+        audio = np.sin(np.arange(300, dtype=np.float32) / 5).astype(np.float32)
+        whole = LinearResampler(22050, 48000).process(audio)
+        chunked = self.resample_chunks(22050, 48000, audio, [1, 1, 7, 50, 3])
+        np.testing.assert_allclose(chunked, whole, atol=1e-6)
+
+
+class IterSentencesTest(unittest.TestCase):
+    """Разбиение входного потока на предложения по мере чтения"""
+
+    def sentences(self, data, **kwargs):
+        return list(iter_sentences(io.BytesIO(data.encode('utf-8')), **kwargs))
+
+    def test_sentence_ends(self):
+        text = "Привет, мир! Как дела? Хорошо...\n«Да.» Абзац\n\nНовый абзац"
+        expected = ["Привет, мир!", "Как дела?", "Хорошо...", "«Да.»", "Абзац", "Новый абзац"]
+        self.assertEqual(self.sentences(text), expected)
+        # Порции по байту режут и многобайтовые символы UTF-8
+        self.assertEqual(self.sentences(text, chunk_size=1), expected)
+
+    def test_long_text_without_punctuation(self):
+        self.assertEqual(self.sentences("ааааа " * 4, max_sentence_chars=10), ["ааааа"] * 4)
+        self.assertEqual(self.sentences("б" * 25, max_sentence_chars=10), ["б" * 10, "б" * 10, "б" * 5])
+
+    def test_sentence_is_yielded_before_end_of_stream(self):
+        class Pipe:
+            """Поток, в котором пока есть только первая порция"""
+            chunks = ["Первое. Вт".encode('utf-8')]
+
+            def read(self, size):
+                if not self.chunks:
+                    raise AssertionError("чтение сверх доступных данных")
+                return self.chunks.pop(0)
+
+        self.assertEqual(next(iter_sentences(Pipe())), "Первое.")
+
+    def test_invalid_utf8_is_replaced(self):
+        self.assertEqual(list(iter_sentences(io.BytesIO(b"ok \xff. Next"), chunk_size=2)), ["ok \ufffd.", "Next"])
+
+
+def encode(text):
+    return base64.b64encode(text.encode('utf-8')).decode('ascii')
+
+
+class TextCommandsTest(unittest.TestCase):
+    """Разбор текстового протокола потокового режима"""
+
+    def parse(self, *lines):
+        return list(iter_text_commands(io.StringIO(''.join(line + '\n' for line in lines))))
+
+    def test_commands(self):
+        commands = self.parse(
+            encode("Привет"),
+            f"{encode('Мир')}|out/a.wav|id=7;normalize=-20",
+            f"PREFETCH:{encode('Скоро')}|id=8",
+            "RELEASE:3",
+            "",
+            "exit",
+            encode("после exit"),
+        )
+        self.assertEqual(commands, [
+            ("synthesize", None, ("Привет", "", {})),
+            ("synthesize", "7", ("Мир", "out/a.wav", {"normalize": "-20"})),
+            ("prefetch", "8", ("Скоро", "", {})),
+            ("release", None, 3),
+            ("exit", None, None),
+        ])
+
+    def test_base64_error_keeps_request_id(self):
+        (command, request_id, message), = self.parse("QUJ|out.wav|id=5")
+        self.assertEqual((command, request_id), ("error", "5"))
+        (command, request_id, message), = self.parse("PREFETCH:/w==|id=6")
+        self.assertEqual((command, request_id), ("error", "6"))
+
+    def test_malformed_commands(self):
+        commands = self.parse("a|b|c|d", "a|b|broken", "RELEASE:x")
+        self.assertEqual([command for command, _, _ in commands], ["error"] * 3)
+
+    def test_extra_separator_keeps_request_id(self):
+        (command, request_id, message), = self.parse(f"{encode('Привет')}|out|a.wav|id=9;normalize=-20")
+        self.assertEqual((command, request_id), ("error", "9"))
+
+
+class BinaryCommandsTest(unittest.TestCase):
+    """Разбор двоичного протокола потокового режима"""
+
+    def frame(self, kind, request_id=0, text='', path='', params=''):
+        text, path, params = text.encode('utf-8'), path.encode('utf-8'), params.encode('utf-8')
+        return BINARY_FRAME_HEADER.pack(kind, 0, 0, request_id, len(text), len(path), len(params)) + text + path + params
+
+    def parse(self, data):
+        return list(iter_binary_commands(io.BytesIO(data)))
+
+    def test_commands(self):
+        commands = self.parse(
+            self.frame(FRAME_SYNTHESIZE, 1, "Привет | мир", "out|a.wav", "normalize=-20")
+            + self.frame(FRAME_PREFETCH, 2, "Скоро")
+            + self.frame(FRAME_RELEASE, 4)
+            + self.frame(9, 5)
+            + self.frame(FRAME_EXIT)
+            + self.frame(FRAME_SYNTHESIZE, 6, "после exit")
+        )
+        self.assertEqual(commands, [
+            ("synthesize", 1, ("Привет | мир", "out|a.wav", {"normalize": "-20"})),
+            ("prefetch", 2, ("Скоро", "", {})),
+            ("release", 4, 4),
+            ("error", 5, "Неизвестный тип кадра: 9"),
+            ("exit", 0, None),
+        ])
+
+    def test_oversized_frame_stops_reading(self):
+        header = BINARY_FRAME_HEADER.pack(FRAME_SYNTHESIZE, 0, 0, 3, MAX_FRAME_SIZE, 1, 0)
+        commands = self.parse(header + b"x" * 10 + self.frame(FRAME_SYNTHESIZE, 4, "Привет"))
+        self.assertEqual(len(commands), 1)
+        self.assertEqual(commands[0][:2], ("error", 3))
+
+    def test_truncated_frame(self):
+        self.assertEqual(self.parse(self.frame(FRAME_SYNTHESIZE, 1, "Привет")[:-2]), [])
+
+    def test_invalid_utf8(self):
+        header = BINARY_FRAME_HEADER.pack(FRAME_SYNTHESIZE, 0, 0, 1, 2, 0, 0)
+        (command, request_id, _), = self.parse(header + b"\xff\xfe")
+        self.assertEqual((command, request_id), ("error", 1))
+
+
+class ClientCommandsTest(unittest.TestCase):
+    """Строки команд клиента и разбор результата в разделяемой памяти"""
+
+    class Writer:
+        def __init__(self):
+            self.lines = []
+
+        def write(self, data):
+            self.lines.append(data)
+
+    def client(self):
+        client = AsyncTTSClient()
+        client._writer = self.Writer()
+        return client
+
+    def test_submit_and_release(self):
+        async def run():
+            client = self.client()
+            client.submit("Привет", "out/a.wav", normalize=-20).cancel()
+            client.prefetch("Пока", sample_rate=48000)
+            client.release(2)
+            return client._writer.lines
+
+        self.assertEqual(asyncio.run(run()), [
+            f"{encode('Привет')}|out/a.wav|normalize=-20;id=1\n".encode('utf-8'),
+            f"PREFETCH:{encode('Пока')}|sample_rate=48000\n".encode('utf-8'),
+            b"RELEASE:2\n",
+        ])
+
+    def test_separators_are_rejected(self):
+        async def run():
+            client = self.client()
+            for output_path, params in (("a|b.wav", {}), ("a\nb.wav", {}), ("a\rb.wav", {}),
+                                        ("a.wav", {"normalize": "-20;trim_silence=1"}),
+                                        ("a.wav", {"normalize": "x=1"}), ("a.wav", {"normalize": "1|2"})):
+                with self.subTest(output_path=output_path, params=params), self.assertRaises(ValueError):
+                    client.submit("Привет", output_path, **params)
+            with self.assertRaises(ValueError):
+                client.prefetch("Привет", normalize="1\n2")
+            self.assertEqual(client._writer.lines, [])
+            self.assertEqual(client._pending, {})
+
+        asyncio.run(run())
+
+    def test_parse_shm_result(self):
+        self.assertEqual(parse_shm_result("shm:psm_1a2b:3:0:10752:22050"), ("psm_1a2b", 3, 0, 10752, 22050))
+        for result in ("out.wav", "shm:psm_1a2b:3:0:10752", "shm:psm_1a2b:x:0:10752:22050"):
+            with self.subTest(result=result), self.assertRaises(ValueError):
+                parse_shm_result(result)
+
+
+class PostProcessorParamsTest(unittest.TestCase):
+    """Проверка параметров постобработки из строк задачи"""
+
+    def test_valid_params(self):
+        post_processor = PostProcessor.from_params({'sample_rate': '16000', 'normalize': '-20', 'trim_silence': '1'})
+        self.assertEqual(post_processor.key, (True, -50.0, -20.0, 16000))
+
+    def test_invalid_params(self):
+        for params in ({'sample_rate': '-8000'}, {'sample_rate': '0'}, {'sample_rate': 'x'},
+                       {'normalize': 'nan'}, {'silence_threshold': 'inf'}, {'unknown': '1'}):
+            with self.subTest(params=params), self.assertRaises(ValueError):
+                PostProcessor.from_params(params)
+
+
+class PrefetchStoreTest(unittest.TestCase):
+    """LRU хранилище результатов предварительного синтеза"""
+
+    def test_eviction_order_and_unused_count(self):
+        store = PrefetchStore(2)
+        store.put("a", "audio-a", 22050)
+        store.put("b", "audio-b", 22050)
+        self.assertEqual(store.get("a"), ("audio-a", 22050))
+        store.put("c", "audio-c", 22050)  # вытесняет "b": "a" использован позже
+        self.assertNotIn("b", store)
+        self.assertIn("a", store)
+        self.assertEqual(store.evicted_unused, 1)
+        store.put("d", "audio-d", 22050)  # вытесняет использованный "a"
+        self.assertNotIn("a", store)
+        self.assertEqual(store.evicted_unused, 1)
+        self.assertIsNone(store.get("a"))
+
+
+class StubSynthesizer:
+    """Синтез без модели: запоминает тексты, может ждать разрешения и завершать рабочий поток"""
+
+    def __init__(self, wait_for=(), exit_on=()):
+        self.texts = []
+        self.started = Event()
+        self.gate = Event()
+        self.wait_for = set(wait_for)
+        self.exit_on = set(exit_on)
+
+    def __call__(self, text, language, post_processor=None, phoneme_ids=None):
+        self.texts.append(text)
+        self.started.set()
+        if text in self.wait_for:
+            self.gate.wait(5)
+        if text in self.exit_on:
+            raise SystemExit  # Завершает рабочий поток, как необработанная ошибка вне синтеза
+        return f"audio:{text}", 22050
+
+
+class StreamSchedulerTest(unittest.TestCase):
+    """Очередь потокового режима: объединение задач и перезапуск рабочих потоков"""
+
+    def setUp(self):
+        self.replies = []
+        self.lock = Lock()
+        # Сообщения планировщика о ходе синтеза тестам не нужны
+        self.output = redirect_stdout(io.StringIO())
+        self.output.__enter__()
+
+    def tearDown(self):
+        self.output.__exit__(None, None, None)
+
+    def reply(self, status, request_id, message):
+        with self.lock:
+            self.replies.append((status, request_id, message))
+
+    def deliver(self, output_path, request_id, audio, sample_rate):
+        self.reply("SUCCESS", request_id, audio)
+
+    def scheduler(self, synthesizer, prefetch_cache=0):
+        scheduler = StreamScheduler([synthesizer], "ru", self.deliver, self.reply, prefetch_cache)
+        scheduler.start()
+        return scheduler
+
+    def wait_for_prefetch(self, scheduler, key):
+        for _ in range(500):
+            if key in scheduler.prefetch_store:
+                return
+            time.sleep(0.01)
+        self.fail(f"предсинтез {key} не выполнен")
+
+    def submit(self, scheduler, text, request_id):
+        scheduler.submit((text,), text, None, None, f"{request_id}.wav", request_id)
+
+    def test_duplicates_are_synthesized_once(self):
+        synthesizer = StubSynthesizer(wait_for={"Привет"})
+        scheduler = self.scheduler(synthesizer)
+        for request_id in ("1", "2", "3"):
+            self.submit(scheduler, "Привет", request_id)
+        synthesizer.gate.set()
+        scheduler.shutdown()
+        self.assertEqual(synthesizer.texts, ["Привет"])
+        self.assertEqual(self.replies, [("SUCCESS", request_id, "audio:Привет") for request_id in ("1", "2", "3")])
+        self.assertEqual(scheduler.coalesced, 2)
+
+    def test_dead_worker_reports_error_to_waiters(self):
+        synthesizer = StubSynthesizer(wait_for={"Привет"}, exit_on={"Привет"})
+        scheduler = self.scheduler(synthesizer)
+        self.submit(scheduler, "Привет", "1")
+        self.submit(scheduler, "Привет", "2")
+        synthesizer.gate.set()
+        scheduler._threads[0].join(5)
+        # Следующая задача перезапускает поток, ожидавшие погибшую задачу получают ERROR
+        self.submit(scheduler, "Пока", "3")
+        scheduler.shutdown()
+        self.assertEqual([(status, request_id) for status, request_id, _ in self.replies],
+                         [("ERROR", "1"), ("ERROR", "2"), ("SUCCESS", "3")])
+
+
+    def test_real_request_cancels_queued_prefetches(self):
+        synthesizer = StubSynthesizer(wait_for={"Первое"})
+        scheduler = self.scheduler(synthesizer, prefetch_cache=4)
+        self.submit(scheduler, "Первое", "1")
+        synthesizer.started.wait(5)
+        self.assertTrue(scheduler.prefetch(("Потом",), "Потом", None, None))
+        self.assertTrue(scheduler.prefetch(("Еще",), "Еще", None, None))
+        self.submit(scheduler, "Второе", "2")
+        synthesizer.gate.set()
+        scheduler.shutdown()
+        self.assertEqual(synthesizer.texts, ["Первое", "Второе"])
+        self.assertEqual(scheduler.prefetch_cancelled, 2)
+        self.assertEqual(scheduler.prefetched, 0)
+
+    def test_prefetch_hit_is_delivered_by_worker(self):
+        threads = []
+        self.deliver = lambda output_path, request_id, audio, sample_rate: (
+            threads.append(current_thread()), self.reply("SUCCESS", request_id, audio))
+        synthesizer = StubSynthesizer()
+        scheduler = self.scheduler(synthesizer, prefetch_cache=4)
+        scheduler.prefetch(("Привет",), "Привет", None, None)
+        self.wait_for_prefetch(scheduler, ("Привет",))
+        self.submit(scheduler, "Привет", "1")
+        scheduler.shutdown()
+        self.assertEqual(synthesizer.texts, ["Привет"])
+        self.assertEqual(self.replies, [("SUCCESS", "1", "audio:Привет")])
+        self.assertEqual(scheduler.prefetch_hits, 1)
+        self.assertIn(threads[0], scheduler._threads)
+
+    def test_dead_worker_during_delivery_reports_error(self):
+        def deliver(output_path, request_id, audio, sample_rate):
+            raise SystemExit
+        self.deliver = deliver
+        scheduler = self.scheduler(StubSynthesizer(), prefetch_cache=4)
+        scheduler.prefetch(("Привет",), "Привет", None, None)
+        self.wait_for_prefetch(scheduler, ("Привет",))
+        self.submit(scheduler, "Привет", "1")
+        scheduler.shutdown()
+        self.assertEqual([(status, request_id) for status, request_id, _ in self.replies], [("ERROR", "1")])
+
+    def test_joined_prefetch_is_not_evicted_unused(self):
+        synthesizer = StubSynthesizer(wait_for={"Привет"})
+        scheduler = self.scheduler(synthesizer, prefetch_cache=1)
+        scheduler.prefetch(("Привет",), "Привет", None, None)
+        synthesizer.started.wait(5)
+        self.submit(scheduler, "Привет", "1")  # Присоединяется к начатому предсинтезу
+        synthesizer.gate.set()
+        self.wait_for_prefetch(scheduler, ("Привет",))
+        scheduler.prefetch(("Пока",), "Пока", None, None)  # Вытесняет результат "Привет"
+        self.wait_for_prefetch(scheduler, ("Пока",))
+        scheduler.shutdown()
+        self.assertEqual(self.replies, [("SUCCESS", "1", "audio:Привет")])
+        self.assertEqual(scheduler.prefetched, 2)
+        self.assertEqual(scheduler.prefetch_store.evicted_unused, 0)
+
+
+@unittest.skipUnless(CONFIG_PATH.exists(), "нет конфигурации модели models/ru.onnx.json")
+class PhonemeCorpusTest(unittest.TestCase):
+    """Сборка корпуса фонем и чтение записей из отображения в память"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.temp_dir.name)
+        catalog = self.root / "lines.tsv"
+        catalog.write_text("quest_42\tЗадание выполнено. Возвращайтесь!\nb\tДа.\nЯ\tПривет, мир.\n",
+                           encoding='utf-8')
+        self.corpus_path = self.root / "lines.phon"
+        self.counts = compile_corpus(read_catalog(catalog), CONFIG_PATH, self.corpus_path)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_round_trip(self):
+        entries, sentences, ids = self.counts
+        corpus = PhonemeCorpus(self.corpus_path)
+        self.assertEqual(entries, 3)
+        self.assertEqual(len(corpus), 3)
+        self.assertEqual(corpus.ids(), ["quest_42", "b", "Я"])
+        self.assertEqual(corpus.metadata['sample_rate'], json.loads(CONFIG_PATH.read_text(encoding='utf-8'))
+                         ['audio']['sample_rate'])
+
+        sentence_ids = [corpus.entry(entry_id) for entry_id in corpus.ids()]
+        self.assertEqual([len(entry) for entry in sentence_ids], [2, 1, 1])
+        self.assertEqual(sum(len(entry) for entry in sentence_ids), sentences)
+        self.assertEqual(sum(len(ids) for entry in sentence_ids for ids in entry), ids)
+        self.assertTrue(all(entry.checksum == config_checksum(CONFIG_PATH) for entry in sentence_ids))
+
+    def test_lookup(self):
+        corpus = PhonemeCorpus(self.corpus_path)
+        self.assertIn("Я", corpus)
+        self.assertNotIn("quest_4", corpus)
+        self.assertNotIn("zzz", corpus)
+        with self.assertRaises(KeyError):
+            corpus.entry("missing")
+
+    def test_checksum_and_format_checks(self):
+        corpus = PhonemeCorpus(self.corpus_path)
+        corpus.verify(config_checksum(CONFIG_PATH))
+        with self.assertRaises(ValueError):
+            corpus.verify(b"\0" * 32)
+        not_corpus = self.root / "other.bin"
+        not_corpus.write_bytes(b"x" * 200)
+        with self.assertRaises(ValueError):
+            PhonemeCorpus(not_corpus)
+
+    def test_duplicate_ids_are_rejected(self):
+        with self.assertRaises(ValueError):
+            compile_corpus([("a", "Да."), ("a", "Нет.")], CONFIG_PATH, self.root / "dup.phon")
+
+
+class TuneTest(unittest.TestCase):
+    """Выбор сочетаний для замера, выбор лучшего и файл профиля"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.temp_dir.name)
+        self.profile_path = self.root / "profile.json"
+        self.model_path = self.root / "ru.onnx"
+        self.model_path.write_bytes(b"model")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_candidate_configs(self):
+        self.assertEqual(candidate_configs(6), [(1, 1), (1, 2), (1, 4), (1, 6), (2, 1), (2, 2), (2, 3), (4, 1), (6, 1)])
+        self.assertTrue(all(workers * threads <= 6 for workers, threads in candidate_configs(6)))
+        self.assertEqual(candidate_configs(8, max_workers=2), [(1, 1), (1, 2), (1, 4), (1, 8), (2, 1), (2, 2), (2, 4)])
+        self.assertEqual(candidate_configs(2, max_workers=16), [(1, 1), (1, 2), (2, 1)])
+        # Явно заданные потоки проверяются как есть
+        self.assertEqual(candidate_configs(2, thread_options=[3, 16]), [(1, 3), (1, 16), (2, 3), (2, 16)])
+
+    def test_select_best(self):
+        results = [
+            {'workers': 1, 'threads': 4, 'audio_per_second': 10.0, 'p95_ms': 100.0},
+            {'workers': 4, 'threads': 1, 'audio_per_second': 30.0, 'p95_ms': 400.0},
+            {'workers': 2, 'threads': 2, 'audio_per_second': 30.0, 'p95_ms': 300.0},
+        ]
+        self.assertEqual(select_best(results)['workers'], 2)  # При равной пропускной способности — меньшая задержка
+        self.assertEqual(select_best(results, max_p95_ms=350)['workers'], 2)
+        self.assertEqual(select_best(results, max_p95_ms=200)['workers'], 1)
+        # Ограничение не выполнимо: сочетание с наименьшей задержкой
+        self.assertEqual(select_best(results, max_p95_ms=50)['workers'], 1)
+
+    def test_profile_round_trip(self):
+        self.assertIsNone(load_profile(self.model_path, self.profile_path))
+        other = {"other-host": {"en.onnx:1": {"workers": 8, "threads": 1}}}
+        self.profile_path.write_text(json.dumps(other), encoding='utf-8')
+        save_profile(self.model_path, {"workers": 2, "threads": 3}, self.profile_path)
+        self.assertEqual(load_profile(self.model_path, self.profile_path), {"workers": 2, "threads": 3})
+        profiles = json.loads(self.profile_path.read_text(encoding='utf-8'))
+        self.assertEqual(profiles["other-host"], other["other-host"])
+        self.assertEqual([path.name for path in self.root.iterdir() if path.name.endswith(".tmp")], [])
+
+    def test_invalid_profiles_are_ignored(self):
+        for profile in ({"workers": 0, "threads": 1}, {"workers": True, "threads": 1}, {"workers": "2", "threads": 1},
+                        {"workers": 2}, [2, 1], None):
+            with self.subTest(profile=profile):
+                save_profile(self.model_path, profile, self.profile_path)
+                self.assertIsNone(load_profile(self.model_path, self.profile_path))
+        for content in ("not json", "[]", json.dumps({hardware_id(): [model_id(self.model_path)]})):
+            with self.subTest(content=content):
+                self.profile_path.write_text(content, encoding='utf-8')
+                self.assertIsNone(load_profile(self.model_path, self.profile_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
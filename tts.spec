@@ -0,0 +1,53 @@
+# -*- mode: python ; coding: utf-8 -*-
+# Сборка onedir для быстрого запуска: pyinstaller tts.spec
+#
+# В отличие от --onefile, ничего не распаковывается во временную папку при каждом запуске.
+# Модели не встраиваются: они лежат в dist/tts/models рядом с исполняемым файлом
+# (или в папке из --models-dir / TTS_MODELS_DIR) и читаются напрямую.
+import shutil
+from pathlib import Path
+
+from PyInstaller.utils.hooks import collect_all
+
+datas, binaries, hiddenimports = [], [], ['piper', 'onnxruntime', 'numpy']
+for package in ('piper', 'onnxruntime'):
+    package_datas, package_binaries, package_hiddenimports = collect_all(package)
+    datas += package_datas
+    binaries += package_binaries
+    hiddenimports += package_hiddenimports
+
+a = Analysis(
+    ['main.py'],
+    pathex=[],
+    binaries=binaries,
+    datas=datas,
+    hiddenimports=hiddenimports,
+    hookspath=[],
+    runtime_hooks=[],
+    excludes=[],
+    noarchive=False,
+)
+pyz = PYZ(a.pure)
+
+exe = EXE(
+    pyz,
+    a.scripts,
+    [],
+    exclude_binaries=True,
+    name='tts',
+    console=True,
+    upx=False,
+)
+
+coll = COLLECT(
+    exe,
+    a.binaries,
+    a.datas,
+    upx=False,
+    name='tts',
+)
+
+# Внешняя папка моделей рядом с exe
+models_dir = Path('models')
+if models_dir.is_dir():
+    shutil.copytree(models_dir, Path(DISTPATH) / 'tts' / 'models', dirs_exist_ok=True)
@@ -0,0 +1,584 @@
+﻿"""Синтез речи Piper как библиотека: аудио в виде NumPy массивов, без вывода в stdout и без файлов
+
+    from tts_api import TTSEngine
+
+    engine = TTSEngine()  # или TTSEngine("path/to/models")
+    for chunk in engine.synthesize_iter("Привет, мир!", "ru"):
+        ...  # int16 массив по каждому предложению
+    engine.synthesize_to("hello.wav", "Привет, мир!", "ru", sample_rate=48000)
+"""
+import codecs
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import sys
+import tempfile
+import wave
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock, local
+
+import numpy as np
+import onnxruntime
+from piper import PiperConfig, PiperVoice
+
+from tts_corpus import phoneme_id_map_checksum
+
+# Библиотека ничего не печатает в stdout; предупреждения (например, о кэше на диске) идут в logging
+logger = logging.getLogger(__name__)
+
+
+def get_resource_path(relative_path):
+    """Получает правильный путь к ресурсам для PyInstaller"""
+    try:
+        # PyInstaller создает временную папку и сохраняет путь в _MEIPASS
+        base_path = sys._MEIPASS
+    except Exception:
+        base_path = os.path.abspath(".")
+
+    return os.path.join(base_path, relative_path)
+
+
+# Переменная окружения с папкой моделей вне exe (не нужно распаковывать модели при каждом запуске)
+MODELS_DIR_ENV = "TTS_MODELS_DIR"
+
+
+def resolve_models_dir(models_dir=None):
+    """Папка моделей: явно указанная, из TTS_MODELS_DIR, models рядом с exe или встроенная в сборку"""
+    if models_dir:
+        return Path(models_dir).absolute()
+
+    env_dir = os.environ.get(MODELS_DIR_ENV)
+    if env_dir:
+        return Path(env_dir).absolute()
+
+    if getattr(sys, 'frozen', False):
+        # Сборка с внешней папкой models рядом с исполняемым файлом
+        external_dir = Path(sys.executable).parent / "models"
+        if external_dir.is_dir():
+            return external_dir
+
+    # Используем функцию для получения правильного пути к моделям
+    return Path(get_resource_path("models"))
+
+
+def parse_bool(value):
+    """Преобразует строковое значение параметра в bool"""
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def float_to_int16(audio):
+    """Преобразует float аудио [-1, 1] в int16"""
+    return (np.clip(audio, -1.0, 1.0) * 32767).astype(np.int16)
+
+
+def trim_silence(audio, sample_rate, threshold_db=-50.0, padding=0.02):
+    """Обрезает тишину в начале и в конце (с небольшим запасом, чтобы не срезать атаку звука)"""
+    threshold = 10 ** (threshold_db / 20)
+    loud = np.flatnonzero(np.abs(audio) > threshold)
+    if loud.size == 0:
+        return audio[:0]
+    pad = int(padding * sample_rate)
+    return audio[max(loud[0] - pad, 0):loud[-1] + pad + 1]
+
+
+def normalize_loudness(audio, target_dbfs=-20.0):
+    """Приводит RMS громкость к целевому уровню в dBFS без клиппинга"""
+    if audio.size == 0:
+        return audio
+    rms = np.sqrt(np.mean(np.square(audio, dtype=np.float64)))
+    peak = np.max(np.abs(audio))
+    if rms == 0 or peak == 0:
+        return audio
+    gain = min(10 ** (target_dbfs / 20) / rms, 1.0 / peak)
+    return (audio * gain).astype(np.float32)
+
+
+class LinearResampler:
+    """Передискретизация линейной интерполяцией, обрабатывает поток фрагментов без разрывов"""
+
+    def __init__(self, source_rate, target_rate):
+        self.step = source_rate / target_rate
+        # Позиция следующего выходного отсчета относительно начала текущего фрагмента
+        self._position = 0.0
+        self._tail = np.zeros(0, dtype=np.float32)
+
+    def process(self, audio):
+        data = np.concatenate((self._tail, audio)) if self._tail.size else audio
+        if data.size < 2:
+            self._tail = data
+            return np.zeros(0, dtype=np.float32)
+
+        last = data.size - 1
+        count = int(np.floor((last - self._position) / self.step)) + 1
+        if count <= 0:
+            # При понижении частоты короткий фрагмент может целиком попасть между выходными отсчетами
+            self._position -= last
+            self._tail = data[-1:]
+            return np.zeros(0, dtype=np.float32)
+        positions = self._position + np.arange(count) * self.step
+        result = np.interp(positions, np.arange(data.size), data).astype(np.float32)
+
+        # Последний входной отсчет нужен для интерполяции на стыке со следующим фрагментом
+        self._position = positions[-1] + self.step - last
+        self._tail = data[-1:]
+        return result
+
+
+class PostProcessor:
+    """Постобработка аудио перед записью: обрезка тишины, нормализация громкости, передискретизация"""
+
+    def __init__(self, trim_silence=False, silence_threshold=-50.0, normalize=None, sample_rate=None):
+        if sample_rate is not None and sample_rate <= 0:
+            raise ValueError(f"Частота дискретизации должна быть положительной: {sample_rate}")
+        if not math.isfinite(silence_threshold):
+            raise ValueError(f"Неверный порог тишины: {silence_threshold}")
+        if normalize is not None and not math.isfinite(normalize):
+            raise ValueError(f"Неверный уровень нормализации: {normalize}")
+        self.trim_silence = trim_silence
+        self.silence_threshold = silence_threshold
+        self.normalize = normalize
+        self.sample_rate = sample_rate
+
+    @classmethod
+    def from_params(cls, params, base=None):
+        """Создает постпроцессор из строковых параметров задачи поверх параметров запуска"""
+        options = {}
+        for key, value in params.items():
+            try:
+                if key == 'trim_silence':
+                    options[key] = parse_bool(value)
+                elif key == 'sample_rate':
+                    options[key] = int(value) if value else None
+                elif key == 'normalize':
+                    options[key] = float(value) if value else None
+                else:
+                    options[key] = float(value)
+            except ValueError:
+                raise ValueError(f"Неверное значение параметра {key}: {value}")
+        return (base or cls()).replace(**options)
+
+    def replace(self, **options):
+        """Возвращает копию с измененными параметрами"""
+        values = dict(vars(self))
+        for key in options:
+            if key not in values:
+                raise ValueError(f"Неизвестный параметр: {key}")
+        values.update(options)
+        return PostProcessor(**values)
+
+    @property
+    def key(self):
+        """Параметры постобработки в виде хешируемого ключа"""
+        return (self.trim_silence, self.silence_threshold, self.normalize, self.sample_rate)
+
+    @property
+    def enabled(self):
+        return self.trim_silence or self.normalize is not None or bool(self.sample_rate)
+
+    def output_rate(self, sample_rate):
+        return self.sample_rate or sample_rate
+
+    def process(self, audio, sample_rate):
+        """Обрабатывает целую фразу (float32) и возвращает аудио и новую частоту"""
+        if self.trim_silence:
+            audio = trim_silence(audio, sample_rate, self.silence_threshold)
+        if self.normalize is not None:
+            audio = normalize_loudness(audio, self.normalize)
+        if self.sample_rate and self.sample_rate != sample_rate:
+            audio = LinearResampler(sample_rate, self.sample_rate).process(audio)
+            sample_rate = self.sample_rate
+        return audio, sample_rate
+
+    def chunk_processor(self, sample_rate):
+        """Функция для пофрагментной обработки потока (обрезка тишины к потоку не применяется)"""
+        if self.normalize is None and not (self.sample_rate and self.sample_rate != sample_rate):
+            return None
+
+        resampler = None
+        if self.sample_rate and self.sample_rate != sample_rate:
+            resampler = LinearResampler(sample_rate, self.sample_rate)
+
+        def process_chunk(audio):
+            if self.normalize is not None:
+                audio = normalize_loudness(audio, self.normalize)
+            if resampler is not None:
+                audio = resampler.process(audio)
+            return audio
+
+        return process_chunk
+
+
+# Конец предложения: знаки препинания (с закрывающими кавычками/скобками) и пробел,
+# либо пустая строка между абзацами
+SENTENCE_END_RE = re.compile(r'[.!?…]+["\'»”)\]]*\s+|\n\s*\n')
+
+
+def iter_sentences(stream, chunk_size=4096, max_sentence_chars=1000):
+    """Читает байты из потока порциями и выдаёт законченные предложения по мере их поступления"""
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    # read1 возвращает то, что уже доступно в pipe, не дожидаясь заполнения всего буфера
+    read = getattr(stream, 'read1', stream.read)
+    buffer = ''
+
+    while True:
+        chunk = read(chunk_size)
+        eof = not chunk
+        buffer += decoder.decode(chunk, final=eof)
+
+        start = 0
+        for match in SENTENCE_END_RE.finditer(buffer):
+            sentence = buffer[start:match.end()].strip()
+            if sentence:
+                yield sentence
+            start = match.end()
+        buffer = buffer[start:]
+
+        # Текст без знаков препинания режем по пробелу, чтобы буфер не рос бесконечно
+        while len(buffer) > max_sentence_chars:
+            cut = buffer.rfind(' ', 0, max_sentence_chars)
+            if cut <= 0:
+                cut = max_sentence_chars
+            sentence = buffer[:cut].strip()
+            if sentence:
+                yield sentence
+            buffer = buffer[cut:]
+
+        if eof:
+            break
+
+    tail = buffer.strip()
+    if tail:
+        yield tail
+
+
+def split_sentences(text):
+    """Делит готовый текст на предложения по тем же правилам, что и iter_sentences"""
+    sentences = []
+    start = 0
+    for match in SENTENCE_END_RE.finditer(text):
+        sentences.append(text[start:match.end()])
+        start = match.end()
+    sentences.append(text[start:])
+    # Лишние пробелы и переносы внутри предложения не меняют речь, но мешали бы попаданиям в кэш
+    return [' '.join(sentence.split()) for sentence in sentences if sentence.strip()]
+
+
+class SentenceCache:
+    """Кэш аудио отдельных предложений для шаблонных фраз
+
+    Фраза делится на предложения, синтезируются только те, которых еще нет в кэше, а аудио
+    склеивается с паузой sentence_silence секунд между предложениями. Кэшируется сырое аудио
+    модели, поэтому постобработка применяется к склеенной фразе, и одна запись подходит для любых
+    ее параметров. Ключ — модель (путь, размер и время изменения файла) и текст предложения.
+    Аудио хранится в int16 в памяти (LRU, не больше max_bytes байт) и, если указана cache_dir,
+    в файлах .npy.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, cache_dir=None, sentence_silence=0.0):
+        self.max_bytes = max_bytes
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.sentence_silence = sentence_silence
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = Lock()
+        # Статистика последней фразы в каждом потоке: (попадания, предложения)
+        self._last = local()
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def last_stats(self):
+        """(попадания, число предложений) последней фразы, синтезированной в текущем потоке"""
+        return getattr(self._last, 'stats', (0, 0))
+
+    @property
+    def memory_bytes(self):
+        """Объем аудио в памяти"""
+        return self._bytes
+
+    def synthesize(self, voice, text):
+        """Возвращает сырое int16 аудио фразы, синтезируя только новые предложения"""
+        sentences = split_sentences(text)
+        pause = np.zeros(int(self.sentence_silence * voice.sample_rate), dtype=np.int16)
+        parts = []
+        hits = 0
+        for sentence in sentences:
+            key = f"{voice.cache_id}\n{sentence}"
+            audio = self._get(key)
+            if audio is None:
+                chunks = [audio_chunk.audio_int16_array for audio_chunk in voice.piper_voice.synthesize(sentence)]
+                audio = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int16)
+                self._put(key, audio)
+            else:
+                hits += 1
+            if parts and len(pause):
+                parts.append(pause)
+            parts.append(audio)
+
+        with self._lock:
+            self.hits += hits
+            self.misses += len(sentences) - hits
+        self._last.stats = (hits, len(sentences))
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int16)
+
+    def _file_path(self, key):
+        return self.cache_dir / f"{hashlib.sha256(key.encode('utf-8')).hexdigest()}.npy"
+
+    def _get(self, key):
+        with self._lock:
+            audio = self._entries.get(key)
+            if audio is not None:
+                self._entries.move_to_end(key)
+                return audio
+
+        if self.cache_dir is None:
+            return None
+        try:
+            audio = np.load(self._file_path(key))
+        except (OSError, ValueError):
+            return None
+        if audio.dtype != np.int16:
+            # Файл из прежних версий кэша, которые хранили float32
+            audio = float_to_int16(audio)
+        self._remember(key, audio)
+        return audio
+
+    def _put(self, key, audio):
+        self._remember(key, audio)
+        if self.cache_dir is None:
+            return
+        # Пишем в свой временный файл (одно предложение могут сохранять несколько потоков и процессов)
+        # и атомарно заменяем. Кэш на диске необязателен: ошибка записи не должна срывать синтез
+        file_path = self._file_path(key)
+        temp_path = None
+        try:
+            handle, temp_path = tempfile.mkstemp(prefix=f"{file_path.stem}.", suffix=".tmp", dir=self.cache_dir)
+            with os.fdopen(handle, 'wb') as temp_file:
+                np.save(temp_file, audio)
+            os.replace(temp_path, file_path)
+        except OSError as e:
+            logger.warning("Не удалось сохранить предложение в кэш %s: %s", self.cache_dir, e)
+            if temp_path is not None:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+
+    def _remember(self, key, audio):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous.nbytes
+            self._entries[key] = audio
+            self._bytes += audio.nbytes
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+
+
+def write_wav(target, audio, sample_rate):
+    """Записывает int16 аудио в WAV файл или в файлоподобный объект"""
+    with wave.open(target if hasattr(target, 'write') else str(target), 'wb') as wav_file:
+        wav_file.setnchannels(1)  # моно
+        wav_file.setsampwidth(2)  # 16-бит
+        wav_file.setframerate(sample_rate)
+        # Число кадров известно заранее, заголовок не придется исправлять (подходит и для pipe)
+        wav_file.setnframes(len(audio))
+        wav_file.writeframes(audio.tobytes())
+
+
+class Voice:
+    """Загруженная модель Piper; можно использовать из нескольких потоков одновременно
+
+    Сессия onnxruntime потокобезопасна, а фонемизатор espeak piper защищает собственной блокировкой.
+    """
+
+    def __init__(self, model_path, config_path=None, threads=None):
+        self.model_path = Path(model_path)
+        self.config_path = Path(config_path) if config_path else self.model_path.with_suffix(".onnx.json")
+        self.threads = threads
+        if threads:
+            self.piper_voice = self._load_with_threads(threads)
+        else:
+            self.piper_voice = PiperVoice.load(str(self.model_path), str(self.config_path))
+        # Идентификатор модели для ключей кэша: замена файла модели делает старые записи недействительными
+        model_stat = self.model_path.stat()
+        self.cache_id = f"{self.model_path.resolve()}:{model_stat.st_size}:{model_stat.st_mtime_ns}"
+
+    def _load_with_threads(self, threads):
+        # PiperVoice.load создает сессию с настройками по умолчанию (все ядра машины),
+        # поэтому сессию с заданным числом потоков собираем сами
+        with open(self.config_path, encoding='utf-8') as config_file:
+            config = PiperConfig.from_dict(json.load(config_file))
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        session = onnxruntime.InferenceSession(
+            str(self.model_path), sess_options=options, providers=["CPUExecutionProvider"]
+        )
+        return PiperVoice(session=session, config=config)
+
+    @property
+    def sample_rate(self):
+        return self.piper_voice.config.sample_rate
+
+    @property
+    def phoneme_id_map_checksum(self):
+        """sha256 таблицы фонем модели, по нему проверяется совместимость корпуса (tts_corpus)"""
+        if not hasattr(self, '_phoneme_id_map_checksum'):
+            self._phoneme_id_map_checksum = phoneme_id_map_checksum(self.piper_voice.config)
+        return self._phoneme_id_map_checksum
+
+    def synthesize_iter(self, text, dtype="int16", post_processor=None, **params):
+        """Выдает аудио по предложениям (int16 или float32) по мере синтеза
+
+        Параметры постобработки (trim_silence, silence_threshold, normalize, sample_rate) применяются
+        к каждому фрагменту; при обрезке тишины фраза выдается одним фрагментом.
+        """
+        if dtype not in ("int16", "float32"):
+            raise ValueError(f"Неподдерживаемый тип данных: {dtype}")
+        post_processor = _make_post_processor(post_processor, params)
+
+        if post_processor.trim_silence:
+            audio, _ = self.synthesize(text, dtype=dtype, post_processor=post_processor)
+            yield audio
+            return
+
+        process_chunk = post_processor.chunk_processor(self.sample_rate)
+        for audio_chunk in self.piper_voice.synthesize(text):
+            if process_chunk is None and dtype == "int16":
+                yield audio_chunk.audio_int16_array
+                continue
+            audio = audio_chunk.audio_float_array
+            if process_chunk is not None:
+                audio = process_chunk(audio)
+            yield float_to_int16(audio) if dtype == "int16" else audio
+
+    def synthesize(self, text, dtype="int16", post_processor=None, sentence_cache=None, **params):
+        """Синтезирует фразу целиком и возвращает (аудио, частота дискретизации)
+
+        С sentence_cache (SentenceCache) синтезируются только предложения, которых нет в кэше.
+        """
+        post_processor = _make_post_processor(post_processor, params)
+        sample_rate = self.sample_rate
+
+        if sentence_cache is not None:
+            audio = sentence_cache.synthesize(self, text)
+            if not post_processor.enabled and dtype == "int16":
+                return audio, sample_rate
+            audio, sample_rate = post_processor.process(audio.astype(np.float32) / 32767, sample_rate)
+            return (float_to_int16(audio) if dtype == "int16" else audio), sample_rate
+
+        if not post_processor.enabled and dtype == "int16":
+            # Без постобработки берем готовые int16 данные
+            chunks = [audio_chunk.audio_int16_array for audio_chunk in self.piper_voice.synthesize(text)]
+            audio = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int16)
+            return audio, sample_rate
+
+        chunks = [audio_chunk.audio_float_array for audio_chunk in self.piper_voice.synthesize(text)]
+        audio = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.float32)
+        audio, sample_rate = post_processor.process(audio, sample_rate)
+        return (float_to_int16(audio) if dtype == "int16" else audio), sample_rate
+
+    def synthesize_ids(self, sentences, dtype="int16", post_processor=None, **params):
+        """Синтезирует фразу из готовых id фонем (по массиву на предложение) без вызова espeak
+
+        Возвращает (аудио, частота дискретизации), как synthesize. Для записи корпуса
+        (tts_corpus.CorpusEntry) проверяется, что корпус собран для таблицы фонем этой модели.
+        """
+        checksum = getattr(sentences, 'checksum', None)
+        if checksum is not None and checksum != self.phoneme_id_map_checksum:
+            raise ValueError(f"Корпус собран для модели с другой таблицей фонем, чем {Path(self.model_path).name}")
+        post_processor = _make_post_processor(post_processor, params)
+        chunks = []
+        for phoneme_ids in sentences:
+            audio = self.piper_voice.phoneme_ids_to_audio(phoneme_ids)
+            # Та же нормализация по пику, что и в PiperVoice.synthesize
+            peak = np.max(np.abs(audio)) if len(audio) else 0.0
+            audio = audio / peak if peak >= 1e-8 else np.zeros_like(audio)
+            chunks.append(np.clip(audio, -1.0, 1.0).astype(np.float32))
+        audio = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.float32)
+        audio, sample_rate = post_processor.process(audio, self.sample_rate)
+        return (float_to_int16(audio) if dtype == "int16" else audio), sample_rate
+
+    def synthesize_to(self, target, text, post_processor=None, sentence_cache=None, **params):
+        """Синтезирует фразу в WAV: путь или файлоподобный объект (например, io.BytesIO)"""
+        audio, sample_rate = self.synthesize(text, post_processor=post_processor, sentence_cache=sentence_cache,
+                                             **params)
+        write_wav(target, audio, sample_rate)
+        return target
+
+
+def _make_post_processor(post_processor, params):
+    post_processor = post_processor or PostProcessor()
+    return post_processor.replace(**params) if params else post_processor
+
+
+class TTSEngine:
+    """Набор моделей из папки models: загружает голоса по языку один раз и кэширует их"""
+
+    def __init__(self, models_dir=None, sentence_cache=None, threads=None):
+        self.models_dir = resolve_models_dir(models_dir)
+        # Необязательный SentenceCache для synthesize и synthesize_to всех языков
+        self.sentence_cache = sentence_cache
+        # Потоков onnxruntime на одну модель (None — по умолчанию, все ядра)
+        self.threads = threads
+        self._voices = {}
+        self._lock = Lock()
+
+    def model_paths(self, language):
+        """Пути к модели и конфигурации для языка"""
+        model_path = self.models_dir / f"{language}.onnx"
+        config_path = self.models_dir / f"{language}.onnx.json"
+
+        if not model_path.exists():
+            raise FileNotFoundError(f"Модель {model_path} не найдена")
+        if not config_path.exists():
+            raise FileNotFoundError(f"Конфигурация {config_path} не найдена")
+        return model_path, config_path
+
+    def available_languages(self):
+        """Языки, для которых в папке есть модель и конфигурация"""
+        return sorted(
+            file.stem for file in self.models_dir.glob("*.onnx")
+            if file.with_suffix(".onnx.json").exists()
+        )
+
+    def is_loaded(self, language):
+        return language in self._voices
+
+    def voice(self, language):
+        """Возвращает голос для языка, загружая модель при первом обращении"""
+        voice = self._voices.get(language)
+        if voice is not None:
+            return voice
+        with self._lock:
+            if language not in self._voices:
+                self._voices[language] = Voice(*self.model_paths(language), threads=self.threads)
+            return self._voices[language]
+
+    def synthesize_iter(self, text, language, dtype="int16", **params):
+        """Выдает аудио по предложениям, см. Voice.synthesize_iter"""
+        return self.voice(language).synthesize_iter(text, dtype=dtype, **params)
+
+    def synthesize(self, text, language, dtype="int16", **params):
+        """Синтезирует фразу целиком и возвращает (аудио, частота дискретизации)"""
+        return self.voice(language).synthesize(text, dtype=dtype, sentence_cache=self.sentence_cache, **params)
+
+    def synthesize_ids(self, sentences, language, dtype="int16", **params):
+        """Синтезирует фразу из id фонем корпуса (tts_corpus.PhonemeCorpus.entry), см. Voice.synthesize_ids"""
+        return self.voice(language).synthesize_ids(sentences, dtype=dtype, **params)
+
+    def synthesize_to(self, target, text, language, **params):
+        """Синтезирует фразу в WAV файл или файлоподобный объект"""
+        return self.voice(language).synthesize_to(target, text, sentence_cache=self.sentence_cache, **params)
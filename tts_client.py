@@ -0,0 +1,329 @@
+﻿"""Клиент потокового режима (main.py --stream) с конвейерной отправкой запросов
+
+Запросы отправляются сразу, не дожидаясь предыдущих. Каждый запрос получает id, и его future
+завершается, как только приходит соответствующий SUCCESS/ERROR — без time.sleep и разбора
+всего stdout в конце.
+
+    async with AsyncTTSClient(language="ru") as client:
+        paths = await asyncio.gather(
+            client.synthesize("Привет", "hello.wav"),
+            client.synthesize("Пока", "bye.wav"),
+        )
+
+    with TTSClient(language="ru") as client:
+        future = client.submit("Привет", "hello.wav")  # concurrent.futures.Future
+        path = client.synthesize("Пока", "bye.wav", timeout=30)
+"""
+import asyncio
+import base64
+import itertools
+import os
+import sys
+import threading
+
+# По умолчанию запускаем main.py, лежащий рядом с клиентом
+DEFAULT_COMMAND = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")]
+
+# Путь результата в разделяемой памяти (main.py --shm-slots)
+SHM_TARGET = "shm:"
+# Разделители строки команды: base64_текст|путь|key=value;key=value
+PATH_SEPARATORS = '|\r\n'
+PARAM_SEPARATORS = ';=|\r\n'
+
+
+class TTSError(Exception):
+    """Процесс TTS ответил ERROR на запрос или завершился, не ответив"""
+
+
+def _check_field(value, separators, name):
+    """Значение поля команды не должно содержать разделителей протокола
+
+    Иначе сервер разберет строку иначе и ответит ERROR без id — future такого запроса не завершится.
+    """
+    value = str(value)
+    if any(separator in value for separator in separators):
+        raise ValueError(f"{name} не может содержать символы {' '.join(map(repr, separators))}: {value!r}")
+    return value
+
+
+def _format_params(params):
+    """Параметры задачи в виде key=value;key=value"""
+    items = []
+    for key, value in params.items():
+        key = _check_field(key, PARAM_SEPARATORS, "Имя параметра")
+        items.append(f"{key}={_check_field(value, PARAM_SEPARATORS, f'Параметр {key}')}")
+    return ';'.join(items)
+
+
+def parse_shm_result(result):
+    """Разбирает результат запроса с путем "shm:": (имя сегмента, слот, смещение, длина в байтах, частота)
+
+    PCM (моно, int16) читается из multiprocessing.shared_memory.SharedMemory(name=имя сегмента);
+    после чтения слот нужно освободить: client.release(слот).
+    """
+    if not result.startswith(SHM_TARGET):
+        raise ValueError(f"Результат не в разделяемой памяти: {result}")
+    try:
+        name, slot, offset, length, sample_rate = result[len(SHM_TARGET):].rsplit(':', 4)
+        return name, int(slot), int(offset), int(length), int(sample_rate)
+    except ValueError:
+        raise ValueError(f"Неверный результат в разделяемой памяти: {result}")
+
+
+class AsyncTTSClient:
+    """Асинхронный клиент: запускает процесс в потоковом режиме или подключается к готовым потокам"""
+
+    def __init__(self, language="ru", command=None, extra_args=(), request_timeout=None, restart=True,
+                 max_restarts=3, ready_timeout=60.0, cwd=None):
+        self.command = list(command or DEFAULT_COMMAND) + ["--stream", "-l", language] + list(extra_args)
+        self.request_timeout = request_timeout
+        self.restart = restart
+        self.max_restarts = max_restarts
+        self.ready_timeout = ready_timeout
+        self.cwd = cwd
+        self.restarts = 0
+        self._process = None
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._ready = None
+        self._closing = False
+        self._ids = itertools.count(1)
+        # id запроса -> (future, строка команды для повторной отправки после перезапуска)
+        self._pending = {}
+        # id запроса -> (ожидание в очереди, время синтеза) из строк TIMING для synthesize_timed
+        self._timings = {}
+
+    @classmethod
+    def attach(cls, reader, writer, request_timeout=None):
+        """Подключается к уже запущенному процессу через asyncio StreamReader/StreamWriter"""
+        client = cls(request_timeout=request_timeout, restart=False)
+        client._reader = reader
+        client._writer = writer
+        client._reader_task = asyncio.ensure_future(client._read_replies())
+        return client
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def start(self):
+        """Запускает процесс TTS и ждет готовности к приему команд"""
+        env = dict(os.environ, PYTHONIOENCODING="utf-8")
+        self._process = await asyncio.create_subprocess_exec(
+            *self.command,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            cwd=self.cwd,
+            env=env
+        )
+        self._reader = self._process.stdout
+        self._writer = self._process.stdin
+        self._ready = asyncio.get_running_loop().create_future()
+        self._reader_task = asyncio.ensure_future(self._read_replies())
+        try:
+            await asyncio.wait_for(asyncio.shield(self._ready), self.ready_timeout)
+        except BaseException:
+            # Процесс, не сообщивший о готовности, не оставляем работать и не перезапускаем
+            self._closing = True
+            self._ready.cancel()
+            if self._process.returncode is None:
+                self._process.kill()
+            await self._process.wait()
+            raise
+
+        # После перезапуска повторяем запросы, на которые не успели ответить
+        for future, line in list(self._pending.values()):
+            if not future.done():
+                self._writer.write(line)
+        await self._writer.drain()
+
+    def submit(self, text, output_path="", **params):
+        """Отправляет запрос без ожидания и возвращает asyncio future с путем результата
+
+        output_path может быть путем к файлу, пустой строкой (имя выберет сервер) или "shm:"
+        (результат разбирает parse_shm_result); params — параметры задачи (sample_rate, normalize,
+        trim_silence, ...). Путь с | или переводом строки и параметры с ; = | или переводом строки
+        не помещаются в строку команды: ValueError.
+        """
+        return self._submit(text, output_path, params)[1]
+
+    def _submit(self, text, output_path, params):
+        output_path = _check_field(output_path, PATH_SEPARATORS, "Путь")
+        request_id = next(self._ids)
+        params_text = _format_params(dict(params, id=request_id))
+        text_b64 = base64.b64encode(text.encode('utf-8')).decode('ascii')
+        line = f"{text_b64}|{output_path}|{params_text}\n".encode('utf-8')
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = (future, line)
+        future.add_done_callback(lambda _: self._pending.pop(request_id, None))
+        self._writer.write(line)
+        return request_id, future
+
+    def prefetch(self, text, **params):
+        """Подсказывает, что текст скоро понадобится: сервер синтезирует его в простое
+
+        Ответа нет; следующий запрос с тем же текстом и параметрами завершится сразу.
+        Еще не начатые подсказки сервер отменяет при любом реальном запросе.
+        """
+        params_text = _format_params(params)
+        text_b64 = base64.b64encode(text.encode('utf-8')).decode('ascii')
+        self._writer.write(f"PREFETCH:{text_b64}|{params_text}\n".encode('utf-8'))
+
+    def release(self, slot):
+        """Освобождает слот разделяемой памяти, когда аудио из него прочитано (см. parse_shm_result)"""
+        self._writer.write(f"RELEASE:{int(slot)}\n".encode('ascii'))
+
+    async def synthesize(self, text, output_path="", timeout=None, **params):
+        """Отправляет запрос и ждет SUCCESS (возвращает путь) или ERROR (исключение TTSError)"""
+        future = self.submit(text, output_path, **params)
+        await self._writer.drain()
+        return await asyncio.wait_for(future, timeout or self.request_timeout)
+
+    async def synthesize_timed(self, text, output_path="", timeout=None, **params):
+        """Как synthesize, но возвращает (путь, ожидание в очереди, время синтеза) в секундах
+
+        Время измеряет сервер (параметр задачи timing=1); для ответа из предсинтеза оба значения равны 0.
+        """
+        request_id, future = self._submit(text, output_path, dict(params, timing=1))
+        try:
+            await self._writer.drain()
+            path = await asyncio.wait_for(future, timeout or self.request_timeout)
+            return (path,) + self._timings.get(request_id, (None, None))
+        finally:
+            self._timings.pop(request_id, None)
+
+    async def close(self):
+        """Отправляет exit и ждет завершения процесса"""
+        self._closing = True
+        if self._writer is not None and not self._writer.is_closing():
+            try:
+                self._writer.write(b"exit\n")
+                await self._writer.drain()
+                self._writer.close()
+            except (ConnectionError, OSError):
+                pass
+        if self._process is not None:
+            await self._process.wait()
+        if self._reader_task is not None:
+            await self._reader_task
+
+    async def _read_replies(self):
+        while True:
+            line = await self._reader.readline()
+            if not line:
+                break
+            self._handle_line(line.decode('utf-8', 'replace').rstrip('\r\n'))
+        await self._on_exit()
+
+    def _handle_line(self, line):
+        if line == "READY":
+            if self._ready is not None and not self._ready.done():
+                self._ready.set_result(None)
+            return
+
+        # Ответы с id: SUCCESS#id:путь, ERROR#id:описание или TIMING#id:ожидание_мс:синтез_мс
+        status, separator, message = line.partition(':')
+        status, tagged, request_id = status.partition('#')
+        if not separator or not tagged or status not in ("SUCCESS", "ERROR", "TIMING"):
+            return
+        try:
+            request_id = int(request_id)
+            entry = self._pending.get(request_id)
+        except ValueError:
+            return
+        if entry is None or entry[0].done():
+            return
+        if status == "TIMING":
+            queue_wait, _, service_time = message.partition(':')
+            try:
+                self._timings[request_id] = (float(queue_wait) / 1000, float(service_time) / 1000)
+            except ValueError:
+                pass
+            return
+        if status == "SUCCESS":
+            entry[0].set_result(message)
+        else:
+            entry[0].set_exception(TTSError(message))
+
+    async def _on_exit(self):
+        if self._process is not None:
+            await self._process.wait()
+
+        # Перезапускаем только процесс, который уже был готов: упавший при запуске упадет снова
+        was_ready = (self._ready is not None and self._ready.done() and not self._ready.cancelled()
+                     and self._ready.exception() is None)
+        can_restart = self.restart and self._process is not None and self.restarts < self.max_restarts
+        if not self._closing and was_ready and can_restart:
+            self.restarts += 1
+            try:
+                await self.start()
+                return
+            except (OSError, asyncio.TimeoutError, TTSError):
+                pass
+
+        error = TTSError("Процесс TTS завершился")
+        if self._ready is not None and not self._ready.done():
+            self._ready.set_exception(error)
+        for future, _ in list(self._pending.values()):
+            if not future.done():
+                future.set_exception(error)
+
+
+class TTSClient:
+    """Синхронная обертка над AsyncTTSClient: цикл asyncio работает в фоновом потоке"""
+
+    def __init__(self, *args, **kwargs):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self._client = AsyncTTSClient(*args, **kwargs)
+        try:
+            self._call(self._client.start())
+        except BaseException:
+            self._stop_loop()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def submit(self, text, output_path="", timeout=None, **params):
+        """Отправляет запрос без ожидания и возвращает concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(
+            self._client.synthesize(text, output_path, timeout, **params), self._loop
+        )
+
+    def prefetch(self, text, **params):
+        """Подсказка предварительного синтеза (см. AsyncTTSClient.prefetch)"""
+        _format_params(params)  # Ошибку параметров сообщаем здесь, а не в потоке цикла asyncio
+        self._loop.call_soon_threadsafe(lambda: self._client.prefetch(text, **params))
+
+    def release(self, slot):
+        """Освобождает слот разделяемой памяти (см. AsyncTTSClient.release)"""
+        slot = int(slot)
+        self._loop.call_soon_threadsafe(lambda: self._client.release(slot))
+
+    def synthesize(self, text, output_path="", timeout=None, **params):
+        """Отправляет запрос и блокируется до ответа; возвращает путь результата"""
+        return self.submit(text, output_path, timeout, **params).result()
+
+    def close(self):
+        try:
+            self._call(self._client.close())
+        finally:
+            self._stop_loop()
+
+    def _stop_loop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
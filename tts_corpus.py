@@ -0,0 +1,239 @@
+﻿"""Корпус фонем: каталог текстов, заранее переведенный espeak в массивы id фонем модели
+
+    from tts_corpus import compile_corpus, read_catalog, PhonemeCorpus
+
+    compile_corpus(read_catalog("lines.jsonl"), "models/ru.onnx.json", "lines.phon")
+    corpus = PhonemeCorpus("lines.phon")
+    audio, sample_rate = engine.voice("ru").synthesize_ids(corpus.entry("quest_42"))
+
+Фонемизация выполняется один раз (например, на машине сборки), а синтез по корпусу подает id
+сразу в сессию onnxruntime, не вызывая espeak. Файл отображается в память (np.memmap) и не
+разбирается целиком: запись ищется двоичным поиском по отсортированному индексу имен,
+id фонем читаются срезами прямо из отображения.
+
+Формат (little-endian, секции выровнены по 8 байт):
+    заголовок   CORPUS_HEADER: сигнатура, версия, число записей, предложений и id,
+                sha256 phoneme_id_map модели, смещения секций
+    записи      ENTRY_DTYPE: смещение и длина id записи в блоке имен, первое предложение, число предложений
+    предложения uint64[число предложений + 1]: границы предложений в массиве id
+    id          uint16[число id]: id фонем всех предложений подряд
+    имена       UTF-8 id записей подряд
+    индекс      uint32[число записей]: номера записей, отсортированные по байтам их id
+    метаданные  JSON: модель, голос espeak, частота дискретизации, время сборки
+"""
+import hashlib
+import json
+import struct
+import time
+from pathlib import Path
+
+import numpy as np
+from piper import PiperConfig, PiperVoice
+
+CORPUS_MAGIC = b"TTSPHON\0"
+CORPUS_VERSION = 2
+# сигнатура, версия, записей, предложений, id, sha256 phoneme_id_map,
+# смещения записей, предложений, id, имен, индекса, метаданных и длина метаданных
+CORPUS_HEADER = struct.Struct('<8sIIIQ32sQQQQQQQ')
+ENTRY_DTYPE = np.dtype([
+    ('name_offset', '<u8'),
+    ('name_length', '<u4'),
+    ('first_sentence', '<u4'),
+    ('sentence_count', '<u4'),
+    ('reserved', '<u4'),
+])
+
+
+def phoneme_id_map_checksum(config):
+    """sha256 таблицы phoneme_id_map: корпус подходит только моделям с той же таблицей"""
+    data = json.dumps(config.phoneme_id_map, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode('utf-8')).digest()
+
+
+def config_checksum(config_path):
+    """sha256 phoneme_id_map по файлу конфигурации модели (.onnx.json), без загрузки модели"""
+    with open(config_path, encoding='utf-8') as config_file:
+        return phoneme_id_map_checksum(PiperConfig.from_dict(json.load(config_file)))
+
+
+def read_catalog(path):
+    """Читает каталог: JSON Lines ({"id": ..., "text": ...}) или строки "id<TAB>текст"
+
+    Строки без табуляции получают id по номеру строки. Выдает пары (id, текст).
+    """
+    with open(path, encoding='utf-8-sig') as catalog_file:
+        for line_number, line in enumerate(catalog_file, 1):
+            line = line.rstrip('\r\n')
+            if not line.strip():
+                continue
+            if line.lstrip().startswith('{'):
+                record = json.loads(line)
+                yield str(record['id']), record['text']
+            elif '\t' in line:
+                entry_id, _, text = line.partition('\t')
+                yield entry_id.strip(), text
+            else:
+                yield str(line_number), line
+
+
+def _align(offset):
+    return (offset + 7) // 8 * 8
+
+
+def compile_corpus(catalog, config_path, output_path):
+    """Фонемизирует каталог (пары id, текст) по конфигурации модели и пишет двоичный корпус
+
+    Нужна только конфигурация модели (.onnx.json): сессия onnxruntime не создается.
+    Возвращает (число записей, число предложений, число id).
+    """
+    with open(config_path, encoding='utf-8') as config_file:
+        config = PiperConfig.from_dict(json.load(config_file))
+    # Для фонемизации сессия не нужна
+    voice = PiperVoice(session=None, config=config)
+
+    names = bytearray()
+    encoded_ids = []
+    entries = []
+    sentence_bounds = [0]
+    ids = []
+    seen = set()
+    for entry_id, text in catalog:
+        if entry_id in seen:
+            raise ValueError(f"Повторяющийся id записи: {entry_id}")
+        seen.add(entry_id)
+
+        encoded_id = entry_id.encode('utf-8')
+        first_sentence = len(sentence_bounds) - 1
+        for phonemes in voice.phonemize(text):
+            if not phonemes:
+                continue
+            ids.extend(voice.phonemes_to_ids(phonemes))
+            sentence_bounds.append(len(ids))
+        entries.append((len(names), len(encoded_id), first_sentence, len(sentence_bounds) - 1 - first_sentence, 0))
+        encoded_ids.append(encoded_id)
+        names += encoded_id
+
+    # Проверяем до преобразования: NumPy 2 сам бросает OverflowError на значениях вне uint16
+    if ids and max(ids) > np.iinfo(np.uint16).max:
+        raise ValueError("id фонем не помещаются в uint16")
+    ids_array = np.array(ids, dtype='<u2')
+    index = sorted(range(len(entries)), key=encoded_ids.__getitem__)
+    metadata = json.dumps({
+        'config': Path(config_path).name,
+        'espeak_voice': config.espeak_voice,
+        'sample_rate': config.sample_rate,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }, ensure_ascii=False).encode('utf-8')
+
+    sections = [
+        np.array(entries, dtype=ENTRY_DTYPE).tobytes(),
+        np.array(sentence_bounds, dtype='<u8').tobytes(),
+        ids_array.tobytes(),
+        bytes(names),
+        np.array(index, dtype='<u4').tobytes(),
+        metadata,
+    ]
+    offsets = []
+    offset = CORPUS_HEADER.size
+    for section in sections:
+        offset = _align(offset)
+        offsets.append(offset)
+        offset += len(section)
+
+    header = CORPUS_HEADER.pack(
+        CORPUS_MAGIC, CORPUS_VERSION, len(entries), len(sentence_bounds) - 1, len(ids),
+        phoneme_id_map_checksum(config), *offsets, len(metadata)
+    )
+    with open(output_path, 'wb') as corpus_file:
+        corpus_file.write(header)
+        for section_offset, section in zip(offsets, sections):
+            corpus_file.write(b'\0' * (section_offset - corpus_file.tell()))
+            corpus_file.write(section)
+
+    return len(entries), len(sentence_bounds) - 1, len(ids)
+
+
+class CorpusEntry(list):
+    """id фонем записи по предложениям; checksum — sha256 phoneme_id_map, для которой собран корпус
+
+    Voice.synthesize_ids сверяет checksum со своей моделью, поэтому запись нельзя по ошибке
+    синтезировать моделью с другой таблицей фонем (например, моделью другого языка).
+    """
+
+    def __init__(self, sentences, checksum=None):
+        super().__init__(sentences)
+        self.checksum = checksum
+
+
+class PhonemeCorpus:
+    """Корпус фонем, отображенный в память; entry(id) возвращает id фонем по предложениям"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._data = np.memmap(self.path, dtype=np.uint8, mode='r')
+        if len(self._data) < CORPUS_HEADER.size:
+            raise ValueError(f"{self.path} не является корпусом фонем")
+        (magic, version, entry_count, sentence_count, id_count, self.checksum, entries_offset,
+         sentences_offset, ids_offset, names_offset, index_offset, metadata_offset, metadata_length) = \
+            CORPUS_HEADER.unpack_from(self._data)
+        if magic != CORPUS_MAGIC:
+            raise ValueError(f"{self.path} не является корпусом фонем")
+        if version != CORPUS_VERSION:
+            raise ValueError(f"Неподдерживаемая версия корпуса: {version}")
+
+        # Представления поверх отображения: данные читаются с диска только при обращении
+        self._entries = np.frombuffer(self._data, ENTRY_DTYPE, entry_count, entries_offset)
+        self._bounds = np.frombuffer(self._data, '<u8', sentence_count + 1, sentences_offset)
+        self._ids = np.frombuffer(self._data, '<u2', id_count, ids_offset)
+        self._index = np.frombuffer(self._data, '<u4', entry_count, index_offset)
+        self._names = self._data[names_offset:index_offset]
+        self._metadata_range = (metadata_offset, metadata_offset + metadata_length)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, entry_id):
+        return self._find(entry_id) is not None
+
+    @property
+    def metadata(self):
+        start, end = self._metadata_range
+        return json.loads(bytes(self._data[start:end]).decode('utf-8'))
+
+    def _name(self, number):
+        entry = self._entries[number]
+        start = int(entry['name_offset'])
+        return bytes(self._names[start:start + int(entry['name_length'])])
+
+    def _find(self, entry_id):
+        """Номер записи по id двоичным поиском в индексе (None, если записи нет)"""
+        target = entry_id.encode('utf-8')
+        low, high = 0, len(self._index)
+        while low < high:
+            middle = (low + high) // 2
+            if self._name(self._index[middle]) < target:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self._index) and self._name(self._index[low]) == target:
+            return int(self._index[low])
+        return None
+
+    def ids(self):
+        """id всех записей в порядке каталога"""
+        return [self._name(number).decode('utf-8') for number in range(len(self._entries))]
+
+    def verify(self, checksum):
+        """Проверяет, что корпус собран для модели с этой таблицей phoneme_id_map"""
+        if checksum != self.checksum:
+            raise ValueError(f"Корпус {self.path.name} собран для модели с другой таблицей фонем")
+
+    def entry(self, entry_id):
+        """id фонем записи: CorpusEntry массивов uint16 по предложениям (срезы отображения, без копирования)"""
+        number = self._find(entry_id)
+        if number is None:
+            raise KeyError(f"Запись {entry_id} не найдена в корпусе {self.path.name}")
+        entry = self._entries[number]
+        first = int(entry['first_sentence'])
+        bounds = self._bounds[first:first + int(entry['sentence_count']) + 1]
+        return CorpusEntry((self._ids[start:end] for start, end in zip(bounds[:-1], bounds[1:])), self.checksum)
@@ -0,0 +1,289 @@
+﻿"""Автонастройка числа рабочих процессов и потоков onnxruntime под машину и модель
+
+    from tts_tune import tune, save_profile
+
+    results, best = tune("models/ru.onnx", "models/ru.onnx.json", language="ru")
+    save_profile("models/ru.onnx", best)
+
+Встроенный набор фраз прогоняется при нескольких сочетаниях workers × threads (процессы × потоки
+сессии onnxruntime в каждом), для каждого измеряется пропускная способность и p95 времени синтеза.
+Профиль хранится по ключам "оборудование" и "модель", поэтому один файл, собранный в CI на разных
+классах машин, подходит всем хостам. main.py (потоковый режим, очередь в папке, разовый синтез)
+читает профиль автоматически; команда настройки: python main.py tune -l ru
+"""
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import socket
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+from tts_api import Voice
+
+# Путь к файлу профиля; по умолчанию — папка настроек пользователя
+PROFILE_ENV = "TTS_PROFILE"
+
+# Короткие, средние и длинные фразы, как в реальных очередях синтеза
+TUNE_CORPUS = {
+    "ru": [
+        "Привет!",
+        "Вы получили пять золотых монет.",
+        "Задание выполнено. Возвращайтесь к старосте деревни за наградой.",
+        "Осторожно, впереди мост, который может не выдержать вашего веса.",
+        "Сегодня в городе ярмарка: торговцы со всего королевства привезли ткани, специи и оружие.",
+        "Да.",
+        "Сохранение игры завершено.",
+        "Когда солнце сядет за горы, ворота крепости закроются, и до утра в город никого не пустят.",
+    ],
+    "en": [
+        "Hello!",
+        "You received five gold coins.",
+        "Quest complete. Return to the village elder for your reward.",
+        "Careful, the bridge ahead may not hold your weight.",
+        "The fair is in town today: merchants from all over the kingdom brought cloth, spices and weapons.",
+        "Yes.",
+        "Game saved.",
+        "When the sun sets behind the mountains, the fortress gates will close and no one will enter until dawn.",
+    ],
+}
+
+
+def tune_corpus(language, texts=16):
+    """Набор фраз для языка (для неизвестных языков — английский) длиной texts"""
+    corpus = TUNE_CORPUS.get(language.split('_')[0], TUNE_CORPUS["en"])
+    return [corpus[i % len(corpus)] for i in range(texts)]
+
+
+def hardware_id():
+    """Класс оборудования: ОС, архитектура, модель процессора и число ядер (без имени хоста)"""
+    cpu_name = platform.processor()
+    try:
+        with open('/proc/cpuinfo', encoding='utf-8') as cpuinfo:
+            for line in cpuinfo:
+                if line.startswith('model name'):
+                    cpu_name = line.partition(':')[2].strip()
+                    break
+    except OSError:
+        pass
+    return f"{platform.system()}-{platform.machine()}|{cpu_name or 'unknown'}|{os.cpu_count()} cpu"
+
+
+def model_id(model_path):
+    """Модель: имя и размер файла (путь не учитывается, чтобы профиль переносился между машинами)"""
+    model_path = Path(model_path)
+    return f"{model_path.name}:{model_path.stat().st_size}"
+
+
+def default_profile_path():
+    """Файл профиля: TTS_PROFILE, иначе %APPDATA%/tts-cli или ~/.config/tts-cli"""
+    if os.environ.get(PROFILE_ENV):
+        return Path(os.environ[PROFILE_ENV])
+    if sys.platform == "win32" and os.environ.get("APPDATA"):
+        config_dir = Path(os.environ["APPDATA"])
+    else:
+        config_dir = Path(os.environ.get("XDG_CONFIG_HOME") or Path.home() / ".config")
+    return config_dir / "tts-cli" / "profile.json"
+
+
+def _read_profiles(path):
+    try:
+        with open(path, encoding='utf-8') as profile_file:
+            profiles = json.load(profile_file)
+        return profiles if isinstance(profiles, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def _positive_int(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+
+def load_profile(model_path, path=None):
+    """Настройки для этого оборудования и модели ({"workers": ..., "threads": ...}) или None
+
+    Записи неверной структуры (файл правили вручную) пропускаются, как и отсутствующие.
+    """
+    profiles = _read_profiles(path or default_profile_path())
+    models = profiles.get(hardware_id())
+    profile = models.get(model_id(model_path)) if isinstance(models, dict) else None
+    if not isinstance(profile, dict) or not all(_positive_int(profile.get(key)) for key in ('workers', 'threads')):
+        return None
+    return profile
+
+
+def save_profile(model_path, profile, path=None):
+    """Записывает настройки для этого оборудования и модели, сохраняя остальные записи файла"""
+    path = Path(path or default_profile_path())
+    profiles = _read_profiles(path)
+    if not isinstance(profiles.get(hardware_id()), dict):
+        profiles[hardware_id()] = {}
+    profiles[hardware_id()][model_id(model_path)] = profile
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(temp_path, 'w', encoding='utf-8') as temp_file:
+        json.dump(profiles, temp_file, ensure_ascii=False, indent=2)
+    os.replace(temp_path, path)
+    return path
+
+
+def candidate_configs(cpu_count=None, max_workers=None, thread_options=None):
+    """Сочетания (workers, threads); по умолчанию workers × threads не превышает число ядер"""
+    cpu_count = cpu_count or os.cpu_count() or 1
+    max_workers = min(max_workers or cpu_count, cpu_count)
+
+    def powers_of_two(limit):
+        values = []
+        value = 1
+        while value <= limit:
+            values.append(value)
+            value *= 2
+        if limit not in values:
+            values.append(limit)
+        return values
+
+    configs = []
+    for workers in powers_of_two(max_workers):
+        # Явно заданные варианты потоков проверяем как есть, в том числе с превышением числа ядер
+        options = thread_options or powers_of_two(max(cpu_count // workers, 1))
+        configs.extend((workers, threads) for threads in options)
+    return configs
+
+
+def _tune_worker_main(model_path, config_path, threads, task_queue, result_queue, start_event):
+    """Рабочий процесс замера: своя сессия onnxruntime с threads потоками"""
+    try:
+        voice = Voice(model_path, config_path, threads=threads)
+        voice.synthesize("Прогрев.")  # Первый запуск сессии заметно медленнее остальных
+    except Exception as e:
+        result_queue.put(('error', str(e)))
+        return
+    result_queue.put(('ready', None))
+    start_event.wait()
+
+    records = []
+    try:
+        while True:
+            text = task_queue.get()
+            if text is None:
+                break
+            started = time.perf_counter()
+            audio, sample_rate = voice.synthesize(text)
+            records.append((time.perf_counter() - started, len(audio) / sample_rate))
+    except Exception as e:
+        result_queue.put(('error', str(e) or type(e).__name__))
+        return
+    result_queue.put(('done', records))
+
+
+def _next_result(result_queue, processes, timeout):
+    """Следующее сообщение рабочих процессов; RuntimeError, если процесс умер молча или истекло время"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return result_queue.get(timeout=0.5)
+        except queue.Empty:
+            pass
+        # Процесс, убитый ОС (например, при нехватке памяти), ничего не отправит
+        dead = [process for process in processes if process.exitcode not in (None, 0)]
+        if dead:
+            raise RuntimeError(f"Рабочий процесс завершился аварийно (код {dead[0].exitcode})")
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Рабочие процессы не ответили за {timeout:.0f} сек")
+
+
+def measure(model_path, config_path, workers, threads, texts, timeout=600.0):
+    """Прогоняет texts на workers процессах и возвращает показатели сочетания"""
+    context = multiprocessing.get_context('spawn')
+    task_queue = context.Queue()
+    result_queue = context.Queue()
+    start_event = context.Event()
+    processes = [
+        context.Process(
+            target=_tune_worker_main,
+            args=(str(model_path), str(config_path), threads, task_queue, result_queue, start_event),
+            daemon=True
+        )
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    try:
+        # Загрузка моделей и прогрев не входят в замер
+        for _ in range(workers):
+            status, message = _next_result(result_queue, processes, timeout)
+            if status == 'error':
+                raise RuntimeError(f"Рабочий процесс не запустился: {message}")
+
+        for text in texts:
+            task_queue.put(text)
+        for _ in range(workers):
+            task_queue.put(None)
+
+        started = time.perf_counter()
+        start_event.set()
+        records = []
+        for _ in range(workers):
+            status, worker_records = _next_result(result_queue, processes, timeout)
+            if status == 'error':
+                raise RuntimeError(f"Ошибка синтеза при workers={workers} threads={threads}: {worker_records}")
+            records.extend(worker_records)
+        elapsed = time.perf_counter() - started
+    finally:
+        # После ошибки остальные процессы могут ждать задач или сигнала старта: не ждем их долго
+        start_event.set()
+        for process in processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.kill()
+
+    latencies = np.array([latency for latency, _ in records])
+    audio_seconds = sum(duration for _, duration in records)
+    return {
+        'workers': workers,
+        'threads': threads,
+        'texts_per_second': round(len(records) / elapsed, 3),
+        'audio_per_second': round(audio_seconds / elapsed, 3),
+        'p95_ms': round(float(np.percentile(latencies, 95)) * 1000, 1),
+        'mean_ms': round(float(latencies.mean()) * 1000, 1),
+    }
+
+
+def select_best(results, max_p95_ms=None):
+    """Наибольшая пропускная способность среди сочетаний, укладывающихся в max_p95_ms"""
+    suitable = [result for result in results if max_p95_ms is None or result['p95_ms'] <= max_p95_ms]
+    # Если ограничение задержки не выполнимо, берем сочетание с наименьшей задержкой
+    if not suitable:
+        return min(results, key=lambda result: result['p95_ms'])
+    return max(suitable, key=lambda result: (result['audio_per_second'], -result['p95_ms']))
+
+
+def tune(model_path, config_path, language="ru", configs=None, texts=16, max_p95_ms=None, report=None):
+    """Замеряет все сочетания и возвращает (результаты, профиль лучшего сочетания)
+
+    report(result) вызывается после замера каждого сочетания.
+    """
+    corpus = tune_corpus(language, texts)
+    results = []
+    for workers, threads in configs or candidate_configs():
+        result = measure(model_path, config_path, workers, threads, corpus)
+        results.append(result)
+        if report is not None:
+            report(result)
+
+    best = select_best(results, max_p95_ms)
+    profile = dict(
+        best,
+        host=socket.gethostname(),
+        tuned_at=time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        texts=len(corpus),
+        max_p95_ms=max_p95_ms,
+        results=results
+    )
+    return results, profile